@@ -12,7 +12,7 @@ def save_results(results_df, selected_patches, patch_data, output_dir='results')
     print(f"📄 CSV saved: {csv_path}")
 
     # Save GeoJSON of selected patches
-    selected_geoms = [patch_data.iloc[patch[0]].geometry for patch in selected_patches]
+    selected_geoms = patch_data.geometry.iloc[results_df['patch_id'].to_numpy()].to_numpy()
     gdf = gpd.GeoDataFrame(results_df, geometry=selected_geoms, crs=patch_data.crs)
     geojson_path = os.path.join(output_dir, 'selected_patches.geojson')
     gdf.to_file(geojson_path, driver='GeoJSON')
@@ -21,7 +21,6 @@ def save_results(results_df, selected_patches, patch_data, output_dir='results')
     # Optional: Save bounding boxes
     bbox_txt_path = os.path.join(output_dir, 'bounding_boxes.txt')
     with open(bbox_txt_path, 'w') as f:
-        for _, row in results_df.iterrows():
-            f.write(f"{row['bbox_coordinates_utm31n']}\n")
+        f.writelines(f"{bbox}\n" for bbox in results_df['bbox_coordinates_utm31n'])
     print(f"📐 Bounding boxes saved: {bbox_txt_path}")
 
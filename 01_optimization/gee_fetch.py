@@ -2,7 +2,32 @@
 import ee
 import os
 import json
+import math
+import time
+import shutil
+import hashlib
+import inspect
 import requests
+import rasterio
+from affine import Affine
+from rasterio.windows import Window, from_bounds, transform as window_transform
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
+
+from layer_cache import LayerCache, cache_key
+
+DOWNLOAD_CHUNK = 1 << 20
+DOWNLOAD_CRS = 'EPSG:32630'
+DOWNLOAD_SCALE = 30
+# getDownloadURL request size limit; a 2048x2048 float64 tile stays under it
+MAX_REQUEST_BYTES = 48 * 1024 * 1024
+TILE_PX = 2048
+LAYER_NAMES = ['study_area', 'urbanProximity', 'slope', 'soil', 'landcoverSuitability', 'floodRisk']
+# Nodata of the single-layer downloads, re-applied per band to the multi-band stack
+LAYER_NODATA = {'study_area': 0, 'floodRisk': 0}
+STACK_NAME = 'layers'
+# Bump when a layer's source data changes without a change to build_layers
+LAYERS_VERSION = 1
 
 def authenticate_gee():
     try:
@@ -34,14 +59,9 @@ def create_study_region(center_lon, center_lat, buffer_km=10):
     )
     return region
 
-def download_gee_data(region, output_folder='gee_data'):
-    os.makedirs(output_folder, exist_ok=True)
-    print("📡 Downloading GEE layers to:", output_folder)
+def build_layers(region):
     layers = {}
 
-    # Projection string to use ONLY for getDownloadURL (not for .reproject)
-    crs_str = 'EPSG:32630'
-
     # Study area mask
     study_area = ee.Image.constant(1).clip(region).rename('study_area')
     layers['study_area'] = study_area
@@ -90,35 +110,271 @@ def download_gee_data(region, output_folder='gee_data'):
     flood_norm = flood.divide(max_depth).rename('floodRisk')
     layers['floodRisk'] = flood_norm
 
-    # Download layers
-    region_geojson = region.getInfo()
-    downloaded = {}
+    return layers
+
+def layers_version():
+    # Cache-key component covering the layer definitions themselves
+    source = inspect.getsource(build_layers)
+    return f"{LAYERS_VERSION}:{hashlib.sha256(source.encode()).hexdigest()[:16]}"
+
+def stack_layers(layers):
+    # Every layer as one float32 band of a single image; masked pixels become 0
+    return ee.Image.cat([layers[name] for name in layers]).toFloat().unmask(0)
 
-    for name, img in layers.items():
-        print(f"   Downloading {name}...")
+def label_bands(path, names):
+    # Band descriptions let grid/mcda address layers by name; nodata is kept per band
+    with rasterio.open(path, 'r+') as dst:
+        dst.nodata = None
+        for band, name in enumerate(names, 1):
+            dst.set_band_description(band, name)
+            if name in LAYER_NODATA:
+                dst.update_tags(band, nodata=LAYER_NODATA[name])
+
+def ee_url_provider(layers, region_geojson, crs='EPSG:32630', scale=30):
+    # name -> signed GeoTIFF URL; swap for any callable to download from another server
+    def provider(name):
+        return layers[name].getDownloadURL({
+            'region': region_geojson,
+            'scale': scale,
+            'crs': crs,
+            'format': 'GEO_TIFF'
+        })
+    return provider
+
+def ee_tile_url_provider(layers, crs='EPSG:32630'):
+    # (name, tile transform, width, height) -> URL for exactly that pixel window
+    def provider(name, transform, width, height):
+        return layers[name].getDownloadURL({
+            'crs': crs,
+            'crs_transform': list(transform)[:6],
+            'dimensions': f"{width}x{height}",
+            'format': 'GEO_TIFF'
+        })
+    return provider
+
+def region_grid(region, crs='EPSG:32630', scale=30):
+    # Pixel grid covering the region in crs, snapped to scale: (transform, width, height)
+    coords = region.bounds(1, crs).coordinates().getInfo()[0]
+    xs, ys = [c[0] for c in coords], [c[1] for c in coords]
+    left = math.floor(min(xs) / scale) * scale
+    top = math.ceil(max(ys) / scale) * scale
+    width = math.ceil((max(xs) - left) / scale)
+    height = math.ceil((top - min(ys)) / scale)
+    return Affine(scale, 0, left, 0, -scale, top), width, height
+
+def tile_windows(width, height, tile_px=TILE_PX):
+    return [Window(col, row, min(tile_px, width - col), min(tile_px, height - row))
+            for row in range(0, height, tile_px)
+            for col in range(0, width, tile_px)]
+
+def create_session(pool_size=6):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def download_layer(session, url_provider, name, path, retries=3, backoff=1.0, timeout=300):
+    """
+    Resolve the layer URL and stream the body to path in chunks. Writes go to a
+    .part file renamed on success, so a failed attempt never leaves a truncated
+    GeoTIFF behind. Retries with exponential backoff on any error.
+    """
+    tmp_path = path + '.part'
+    for attempt in range(retries + 1):
         try:
-            url = img.getDownloadURL({
-                'region': region_geojson,
-                'scale': 30,
-                'crs': crs_str,
-                'format': 'GEO_TIFF'
-            })
-            resp = requests.get(url)
-            if resp.status_code == 200:
-                path = os.path.join(output_folder, f"{name}.tif")
-                with open(path, 'wb') as f:
-                    f.write(resp.content)
-                downloaded[name] = path
-                print(f"   ✅ {name} saved to {path}")
-            else:
-                print(f"   ❌ Failed {name} ({resp.status_code})")
+            url = url_provider(name)
+            with session.get(url, stream=True, timeout=timeout) as resp:
+                resp.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK):
+                        f.write(chunk)
+            os.replace(tmp_path, path)
+            return path
         except Exception as e:
-            print(f"   ❌ Error downloading {name}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"   ⚠️ {name} attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
 
+def download_layers(url_provider, names, output_folder, workers=6, retries=3, backoff=1.0, session=None):
+    # Concurrent downloads over one pooled session; returns {name: path} of successes
+    os.makedirs(output_folder, exist_ok=True)
+    own_session = session is None
+    session = session or create_session(workers)
+    downloaded = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(download_layer, session, url_provider, name,
+                                os.path.join(output_folder, f"{name}.tif"), retries, backoff): name
+                for name in names
+            }
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    downloaded[name] = future.result()
+                    print(f"   ✅ {name} saved to {downloaded[name]}")
+                except Exception as e:
+                    print(f"   ❌ Error downloading {name}: {e}")
+    finally:
+        if own_session:
+            session.close()
+    # Keep the layer order stable regardless of completion order
+    return {name: downloaded[name] for name in names if name in downloaded}
+
+def download_tiled(tile_url_provider, names, output_folder, transform, width, height, crs,
+                   tile_px=TILE_PX, workers=6, retries=3, backoff=1.0):
+    """
+    Fetch every layer as tile_px tiles of one pixel grid and mosaic them into
+    <output_folder>/<name>.tif. All tiles of all layers share one thread pool and
+    session. Finished tiles and per-layer done markers persist under
+    .tiles/<grid hash>/, so a rerun after a failure only fetches what is missing.
+    The tile directory is removed once every layer is mosaicked.
+    """
+    windows = tile_windows(width, height, tile_px)
+    grid_id = hashlib.sha256(repr((list(transform)[:6], width, height, str(crs), tile_px)).encode()).hexdigest()[:12]
+    tile_dir = os.path.join(output_folder, '.tiles', grid_id)
+    os.makedirs(tile_dir, exist_ok=True)
+
+    outputs = {name: os.path.join(output_folder, f"{name}.tif") for name in names}
+    # Layers mosaicked by an earlier run on this grid are not fetched again
+    finished = {name for name in names
+                if os.path.exists(os.path.join(tile_dir, f"{name}.done")) and os.path.exists(outputs[name])}
+    tiles = {name: [os.path.join(tile_dir, f"{name}_{w.row_off}_{w.col_off}.tif") for w in windows] for name in names}
+    pending = [(name, window, path) for name in names if name not in finished
+               for window, path in zip(windows, tiles[name]) if not os.path.exists(path)]
+    total = len(names) * len(windows)
+    done = total - len(pending)
+    print(f"   🧩 {width}x{height} px in {len(windows)} tiles per layer, {done}/{total} tiles already on disk")
+
+    failed = set()
+    session = create_session(workers)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for name, window, path in pending:
+                def url_provider(_, name=name, window=window):
+                    return tile_url_provider(name, window_transform(window, transform),
+                                             int(window.width), int(window.height))
+                label = f"{name}[{window.row_off},{window.col_off}]"
+                futures[executor.submit(download_layer, session, url_provider, label, path, retries, backoff)] = name
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    done += 1
+                    print(f"   ⏬ {done}/{total} tiles")
+                except Exception as e:
+                    failed.add(futures[future])
+                    print(f"   ❌ Tile of {futures[future]} failed: {e}")
+    finally:
+        session.close()
+
+    downloaded = {}
+    for name in names:
+        if name in failed:
+            print(f"   ❌ Skipping mosaic of {name}: missing tiles kept for resume in {tile_dir}")
+            continue
+        if name not in finished:
+            mosaic_tiles(tiles[name], outputs[name], transform, width, height, crs)
+            open(os.path.join(tile_dir, f"{name}.done"), 'w').close()
+            for tile_path in tiles[name]:
+                os.remove(tile_path)
+            print(f"   ✅ {name} mosaicked to {outputs[name]}")
+        downloaded[name] = outputs[name]
+    if not failed:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+        # Drop .tiles itself unless another grid still has tiles pending there
+        try:
+            os.rmdir(os.path.dirname(tile_dir))
+        except OSError:
+            pass
+    return downloaded
+
+def mosaic_tiles(tile_paths, out_path, transform, width, height, crs):
+    # Window-by-window copy: only one tile is in memory at a time
+    with rasterio.open(tile_paths[0]) as first:
+        profile = {
+            'driver': 'GTiff', 'width': width, 'height': height, 'count': first.count,
+            'dtype': first.dtypes[0], 'nodata': first.nodata, 'crs': crs, 'transform': transform,
+            'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'BIGTIFF': 'IF_SAFER'
+        }
+        descriptions = first.descriptions
+    tmp_path = out_path + '.part'
+    with rasterio.open(tmp_path, 'w', **profile) as dst:
+        dst.descriptions = descriptions
+        for tile_path in tile_paths:
+            with rasterio.open(tile_path) as tile:
+                window = from_bounds(*tile.bounds, transform=transform).round_offsets().round_lengths()
+                dst.write(tile.read(), window=window)
+    os.replace(tmp_path, out_path)
+
+def download_gee_data(region, output_folder='gee_data', workers=6, url_provider=None, tile_px=TILE_PX,
+                      multiband=False):
+    """
+    Download every layer of the region. With multiband, the layers are fetched as
+    one stacked image (one request, or one per tile) into <output_folder>/layers.tif,
+    and every layer name maps to that file; grid and mcda read the band by name.
+    """
+    print("📡 Downloading GEE layers to:", output_folder)
+    layers = build_layers(region)
+    names = list(layers)
+    region_geojson = region.getInfo()
+    fetch = {STACK_NAME: stack_layers(layers)} if multiband else layers
+    if multiband:
+        # Six float32 bands per pixel instead of one, so tiles shrink to stay under the limit
+        tile_px = min(tile_px, int(math.sqrt(MAX_REQUEST_BYTES / (4 * len(names)))) // 256 * 256)
+
+    if url_provider is None:
+        # Regions over one getDownloadURL request are fetched as tiles and mosaicked
+        transform, width, height = region_grid(region, DOWNLOAD_CRS, DOWNLOAD_SCALE)
+        if max(width, height) > tile_px:
+            os.makedirs(output_folder, exist_ok=True)
+            downloaded = download_tiled(ee_tile_url_provider(fetch, DOWNLOAD_CRS), list(fetch), output_folder,
+                                        transform, width, height, DOWNLOAD_CRS, tile_px=tile_px, workers=workers)
+        else:
+            # Projection to use ONLY for getDownloadURL (not for .reproject)
+            url_provider = ee_url_provider(fetch, region_geojson, crs=DOWNLOAD_CRS, scale=DOWNLOAD_SCALE)
+    if url_provider is not None:
+        downloaded = download_layers(url_provider, list(fetch), output_folder, workers=workers)
+
+    if multiband:
+        if STACK_NAME not in downloaded:
+            return {}, region_geojson
+        label_bands(downloaded[STACK_NAME], names)
+        downloaded = {name: downloaded[STACK_NAME] for name in names}
     return downloaded, region_geojson
 
-def setup_data_automatically(center_lon, center_lat, buffer_km=10, output_folder='gee_data'):
+def setup_data_automatically(center_lon, center_lat, buffer_km=10, output_folder='gee_data', workers=6, cache=True,
+                             multiband=False):
+    """
+    Fetch the layers for a study region into output_folder. With cache enabled
+    (True or a LayerCache), a previous fetch of the same center, buffer, CRS, scale
+    and layer definitions is copied from disk without authenticating or any
+    network access; complete fresh downloads are added to the cache.
+    """
+    if cache is True:
+        cache = LayerCache()
+    key = cache_key(center_lon, center_lat, buffer_km, DOWNLOAD_CRS, DOWNLOAD_SCALE, layers_version(),
+                    multiband=multiband)
+
+    if cache:
+        hit = cache.get(key, LAYER_NAMES)
+        if hit is not None:
+            cached_files, region_geojson = hit
+            os.makedirs(output_folder, exist_ok=True)
+            for path in set(cached_files.values()):
+                shutil.copy2(path, os.path.join(output_folder, os.path.basename(path)))
+            files = {name: os.path.join(output_folder, os.path.basename(cached_files[name])) for name in LAYER_NAMES}
+            print(f"⚡ Using cached GEE layers ({key[:12]}) for {center_lon:.4f}, {center_lat:.4f}")
+            return files, region_geojson
+
     authenticate_gee()
     region = create_study_region(center_lon, center_lat, buffer_km)
-    files, region_geojson = download_gee_data(region, output_folder)
+    files, region_geojson = download_gee_data(region, output_folder, workers=workers, multiband=multiband)
+    if cache and all(name in files for name in LAYER_NAMES):
+        cache.put(key, files, region_geojson)
     return files, region_geojson
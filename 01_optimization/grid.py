@@ -1,16 +1,19 @@
 # grid.py
 import rasterio
+from concurrent.futures import ProcessPoolExecutor
 from rasterio.mask import mask
+from rasterio.windows import Window
 import geopandas as gpd
 import numpy as np
-from shapely.geometry import box
+import shapely
+from raster_stack import RasterStack, open_layer, layer_band, band_nodata
 
 def load_and_check_rasters(file_paths):
     rasters = {}
     print("\n🗺️ Loading rasters:")
     for name, path in file_paths.items():
         try:
-            src = rasterio.open(path)
+            src = open_layer(path, name)
             rasters[name] = src
             arr = src.read(1).astype(float)
             if src.nodata is not None:
@@ -20,37 +23,198 @@ def load_and_check_rasters(file_paths):
             print(f"✗ {name}: failed to load ({e})")
     return rasters
 
-def create_patch_grid(raster, grid_size):
+def load_raster_stack(file_paths, memmap_dir=None):
+    stack = RasterStack(file_paths, memmap_dir=memmap_dir)
+    print("\n🗺️ Loading raster stack:")
+    for name, layer in stack.items():
+        stats = layer.stats
+        print(f"✓ {name}: shape={layer.shape}, CRS={layer.crs}, min={stats['min']:.3f}, "
+              f"max={stats['max']:.3f}, valid={stats['valid_count']}")
+    return stack
+
+def create_patch_grid(raster, grid_size, offset_x=0.0, offset_y=0.0):
     left, bottom, right, top = raster.bounds
+    left += offset_x
+    bottom += offset_y
     cols = max(1, int((right - left) / grid_size))
     rows = max(1, int((top - bottom) / grid_size))
 
-    patches = []
-    for row in range(rows):
-        for col in range(cols):
-            patch_left = left + col * grid_size
-            patch_bottom = bottom + (rows - row - 1) * grid_size
-            patch_right = patch_left + grid_size
-            patch_top = patch_bottom + grid_size
-            poly = box(patch_left, patch_bottom, patch_right, patch_top)
-            centroid = poly.centroid
-            patches.append({
-                'id': row * cols + col,
-                'geometry': poly,
-                'centroid_x': centroid.x,
-                'centroid_y': centroid.y,
-                'row': row,
-                'col': col
-            })
-
-    gdf = gpd.GeoDataFrame(patches, geometry='geometry', crs=raster.crs)
+    ids = np.arange(rows * cols)
+    row, col = np.divmod(ids, cols)
+    patch_left = left + col * grid_size
+    patch_bottom = bottom + (rows - row - 1) * grid_size
+    patch_right = patch_left + grid_size
+    patch_top = patch_bottom + grid_size
+
+    gdf = gpd.GeoDataFrame({
+        'id': ids,
+        'geometry': shapely.box(patch_left, patch_bottom, patch_right, patch_top),
+        'centroid_x': (patch_left + patch_right) / 2,
+        'centroid_y': (patch_bottom + patch_top) / 2,
+        'row': row,
+        'col': col
+    }, geometry='geometry', crs=raster.crs)
     print(f"Created {len(gdf)} patches in grid")
     return gdf
 
-def extract_patch_statistics(patch_grid, rasters):
-    for name in rasters:
+def patch_labels(patch_grid, transform, shape):
+    # Positional patch index for every pixel whose centre falls inside a grid cell, -1 elsewhere.
+    # Relies on the axis-aligned square cells and row/col columns produced by create_patch_grid.
+    first = patch_grid.geometry.iloc[0].bounds
+    grid_size = first[2] - first[0]
+    origin_x = first[0] - patch_grid['col'].iloc[0] * grid_size
+    origin_y = first[3] + patch_grid['row'].iloc[0] * grid_size
+
+    rows = patch_grid['row'].to_numpy()
+    cols = patch_grid['col'].to_numpy()
+    lookup = np.full((rows.max() + 1, cols.max() + 1), -1, dtype=np.int64)
+    lookup[rows, cols] = np.arange(len(patch_grid))
+
+    height, width = shape
+    xs = transform.c + transform.a * (np.arange(width) + 0.5)
+    ys = transform.f + transform.e * (np.arange(height) + 0.5)
+    pixel_cols = np.floor((xs - origin_x) / grid_size).astype(np.int64)
+    pixel_rows = np.floor((origin_y - ys) / grid_size).astype(np.int64)
+    col_ok = (pixel_cols >= 0) & (pixel_cols < lookup.shape[1])
+    row_ok = (pixel_rows >= 0) & (pixel_rows < lookup.shape[0])
+
+    labels = np.full((height, width), -1, dtype=np.int64)
+    inside = row_ok[:, None] & col_ok[None, :]
+    labels[inside] = lookup[np.clip(pixel_rows, 0, lookup.shape[0] - 1)[:, None],
+                            np.clip(pixel_cols, 0, lookup.shape[1] - 1)[None, :]][inside]
+    return labels
+
+# Extra per-patch statistics used for siting; the mean of every layer is always extracted.
+# Supported names: mean, std, min, max, valid_fraction and percentiles written as pNN.
+SITING_STATISTICS = {
+    'slope': ['std', 'min', 'max', 'valid_fraction'],
+    'landcoverSuitability': ['std', 'min', 'max', 'valid_fraction'],
+    'soil': ['std', 'min', 'max', 'valid_fraction'],
+    'urbanProximity': ['std', 'min', 'max', 'valid_fraction'],
+    'floodRisk': ['std', 'min', 'max', 'valid_fraction', 'p90'],
+}
+
+def _zonal_statistics(arr, nodata, labels, n_patches, statistics=()):
+    # All requested statistics of one layer from a single pass over its pixels
+    in_grid = labels >= 0
+    valid = ~np.isnan(arr) & in_grid
+    if nodata is not None:
+        valid &= arr != nodata
+    values = arr[valid]
+    bins = labels[valid] + 1
+    counts = np.bincount(bins, minlength=n_patches + 1)[1:]
+    sums = np.bincount(bins, weights=values, minlength=n_patches + 1)[1:]
+    has_data = counts > 0
+    means = np.full(n_patches, np.nan)
+    np.divide(sums, counts, out=means, where=has_data)
+    result = {'mean': means}
+
+    order_stats = [s for s in statistics if s in ('min', 'max') or s.startswith('p')]
+    if order_stats:
+        # One sort by (patch, value) serves min, max and every percentile
+        order = np.lexsort((values, bins))
+        sorted_values = values[order]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        last = starts + np.maximum(counts - 1, 0)
+
+    for stat in statistics:
+        out = np.full(n_patches, np.nan)
+        if stat == 'mean':
+            continue
+        elif stat == 'std':
+            deviations = (values - means[bins - 1]) ** 2
+            squares = np.bincount(bins, weights=deviations, minlength=n_patches + 1)[1:]
+            np.divide(squares, counts, out=out, where=has_data)
+            out = np.sqrt(out)
+        elif stat == 'valid_fraction':
+            cells = np.bincount(labels[in_grid], minlength=n_patches)
+            out = np.zeros(n_patches)
+            np.divide(counts, cells, out=out, where=cells > 0)
+        elif stat == 'min':
+            out[has_data] = sorted_values[starts[has_data]]
+        elif stat == 'max':
+            out[has_data] = sorted_values[last[has_data]]
+        elif stat.startswith('p') and stat[1:].isdigit():
+            # Linear interpolation between ranks, matching np.percentile's default
+            position = starts + (counts - 1) * float(stat[1:]) / 100.0
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            lower_v = sorted_values[lower[has_data]]
+            upper_v = sorted_values[upper[has_data]]
+            out[has_data] = lower_v + (upper_v - lower_v) * (position - lower)[has_data]
+        else:
+            raise ValueError(f"Unknown patch statistic: {stat}")
+        result[stat] = out
+    return result
+
+def _extract_zonal(patch_grid, rasters, statistics):
+    label_cache = {}
+    for name, raster in rasters.items():
+        key = (tuple(raster.transform), raster.shape)
+        if key not in label_cache:
+            label_cache[key] = patch_labels(patch_grid, raster.transform, raster.shape)
+        arr = raster.read(1).astype(float)
+        layer_stats = _zonal_statistics(arr, raster.nodata, label_cache[key], len(patch_grid),
+                                        statistics.get(name, ()))
+        patch_grid[name] = layer_stats.pop('mean')
+        for stat, values in layer_stats.items():
+            patch_grid[f"{name}_{stat}"] = values
+
+def _band_window(src, band_grid):
+    # Pixel rows whose centres fall between the band's top and bottom edges
+    t = src.transform
+    miny, maxy = band_grid.geometry.bounds['miny'].min(), band_grid.geometry.bounds['maxy'].max()
+    row_start = int(np.clip(np.ceil((maxy - t.f) / t.e - 0.5), 0, src.height))
+    row_stop = int(np.clip(np.ceil((miny - t.f) / t.e - 0.5), 0, src.height))
+    return Window(0, row_start, src.width, row_stop - row_start)
+
+def _extract_band(file_paths, band_grid, statistics):
+    # Runs in a worker process: open the rasters here, read only this band's rows
+    columns = {}
+    label_cache = {}
+    for name, path in file_paths.items():
+        with rasterio.open(path) as src:
+            band = layer_band(src, name)
+            window = _band_window(src, band_grid)
+            transform = src.window_transform(window)
+            arr = src.read(band, window=window).astype(float)
+            nodata = band_nodata(src, band)
+        key = (tuple(transform), arr.shape)
+        if key not in label_cache:
+            label_cache[key] = patch_labels(band_grid, transform, arr.shape)
+        layer_stats = _zonal_statistics(arr, nodata, label_cache[key], len(band_grid),
+                                        statistics.get(name, ()))
+        columns[name] = layer_stats.pop('mean')
+        for stat, values in layer_stats.items():
+            columns[f"{name}_{stat}"] = values
+    return columns
+
+def extract_patch_statistics_parallel(patch_grid, file_paths, workers=4, statistics=None):
+    # Same output as extract_patch_statistics(method="zonal"), computed over row bands
+    # of the grid in a process pool. Takes file paths since datasets can't be pickled.
+    statistics = statistics or {}
+    rows = patch_grid['row'].to_numpy()
+    bands = [b for b in np.array_split(np.unique(rows), workers * 2) if len(b)]
+    band_positions = [np.flatnonzero(np.isin(rows, band)) for band in bands]
+    band_grids = [patch_grid.iloc[pos][['geometry', 'row', 'col']] for pos in band_positions]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_extract_band, [file_paths] * len(band_grids), band_grids,
+                                [statistics] * len(band_grids)))
+
+    for name in file_paths:
         patch_grid[name] = np.nan
+    for positions, columns in zip(band_positions, results):
+        for col, values in columns.items():
+            if col not in patch_grid:
+                patch_grid[col] = np.nan
+            patch_grid.iloc[positions, patch_grid.columns.get_loc(col)] = values
 
+    filtered = patch_grid.dropna(subset=list(file_paths.keys()))
+    print(f"Extracted stats with {workers} workers: {len(filtered)} valid patches / {len(patch_grid)} total")
+    return filtered
+
+def _extract_with_mask(patch_grid, rasters):
     for idx, patch in patch_grid.iterrows():
         geom = [patch.geometry]
         for name, raster in rasters.items():
@@ -64,6 +228,21 @@ def extract_patch_statistics(patch_grid, rasters):
             except Exception:
                 patch_grid.at[idx, name] = np.nan
 
+def extract_patch_statistics(patch_grid, rasters, method="zonal", statistics=None):
+    # statistics: optional {layer: [stat, ...]} of extra columns named <layer>_<stat>
+    statistics = statistics or {}
+    for name in rasters:
+        patch_grid[name] = np.nan
+
+    if method == "zonal":
+        _extract_zonal(patch_grid, rasters, statistics)
+    elif statistics:
+        raise ValueError("Extra patch statistics require method='zonal'")
+    elif method == "mask":
+        _extract_with_mask(patch_grid, rasters)
+    else:
+        raise ValueError(f"Unknown extraction method: {method}")
+
     filtered = patch_grid.dropna(subset=list(rasters.keys()))
     print(f"Extracted stats: {len(filtered)} valid patches / {len(patch_grid)} total")
     return filtered
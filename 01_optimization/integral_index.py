@@ -0,0 +1,132 @@
+# integral_index.py
+import os
+import json
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+
+import grid
+
+
+class IntegralIndex:
+    """
+    Summed-area tables of every layer plus a valid-pixel count table, so the mean
+    over any axis-aligned pixel window is an O(1) lookup. Pixels belong to the
+    window containing their centre, the same rule used by grid.extract_patch_statistics.
+    """
+
+    def __init__(self, sums, counts, transform, crs, shape):
+        self.sums = sums
+        self.counts = counts
+        self.transform = transform
+        self.crs = crs
+        self.shape = shape
+
+    @classmethod
+    def build(cls, rasters):
+        sums, counts = {}, {}
+        transform = shape = crs = None
+        for name, raster in rasters.items():
+            arr = raster.read(1).astype(float)
+            valid = ~np.isnan(arr)
+            if raster.nodata is not None:
+                valid &= arr != raster.nodata
+            sums[name] = _summed_area(np.where(valid, arr, 0.0))
+            counts[name] = _summed_area(valid.astype(np.int64))
+            transform, shape, crs = raster.transform, raster.shape, raster.crs
+        print(f"📇 Built integral index for {len(sums)} layers")
+        return cls(sums, counts, transform, crs, shape)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.sums:
+            np.save(os.path.join(directory, f"{name}_sum.npy"), self.sums[name])
+            np.save(os.path.join(directory, f"{name}_count.npy"), self.counts[name])
+        meta = {
+            "layers": list(self.sums),
+            "transform": list(self.transform)[:6],
+            "crs": self.crs.to_wkt() if self.crs else None,
+            "shape": list(self.shape)
+        }
+        with open(os.path.join(directory, "index.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        print(f"💾 Saved integral index to {directory}")
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        with open(os.path.join(directory, "index.json")) as f:
+            meta = json.load(f)
+        sums, counts = {}, {}
+        for name in meta["layers"]:
+            sums[name] = np.load(os.path.join(directory, f"{name}_sum.npy"), mmap_mode=mmap_mode)
+            counts[name] = np.load(os.path.join(directory, f"{name}_count.npy"), mmap_mode=mmap_mode)
+        crs = CRS.from_wkt(meta["crs"]) if meta["crs"] else None
+        return cls(sums, counts, Affine(*meta["transform"]), crs, tuple(meta["shape"]))
+
+    @property
+    def layers(self):
+        return list(self.sums)
+
+    @property
+    def bounds(self):
+        height, width = self.shape
+        left, top = self.transform.c, self.transform.f
+        right = left + self.transform.a * width
+        bottom = top + self.transform.e * height
+        return left, bottom, right, top
+
+    def pixel_window(self, minx, miny, maxx, maxy):
+        # Pixel row/col ranges [start, stop) whose centres fall in [minx, maxx) x (miny, maxy]
+        t = self.transform
+        height, width = self.shape
+        col_start = np.clip(np.ceil((np.asarray(minx) - t.c) / t.a - 0.5), 0, width).astype(np.int64)
+        col_stop = np.clip(np.ceil((np.asarray(maxx) - t.c) / t.a - 0.5), 0, width).astype(np.int64)
+        row_start = np.clip(np.ceil((np.asarray(maxy) - t.f) / t.e - 0.5), 0, height).astype(np.int64)
+        row_stop = np.clip(np.ceil((np.asarray(miny) - t.f) / t.e - 0.5), 0, height).astype(np.int64)
+        return row_start, row_stop, col_start, col_stop
+
+    def window_sums(self, name, row_start, row_stop, col_start, col_stop):
+        sums = _window_total(self.sums[name], row_start, row_stop, col_start, col_stop)
+        counts = _window_total(self.counts[name], row_start, row_stop, col_start, col_stop)
+        return sums, counts
+
+    def window_means(self, name, row_start, row_stop, col_start, col_stop):
+        sums, counts = self.window_sums(name, row_start, row_stop, col_start, col_stop)
+        means = np.full(np.shape(sums), np.nan)
+        np.divide(sums, counts, out=means, where=counts > 0)
+        return means
+
+    def sliding_window_means(self, name, size_px):
+        # Mean of every size_px x size_px pixel window, indexed by its top-left pixel
+        height, width = self.shape
+        rows = np.arange(height - size_px + 1)[:, None]
+        cols = np.arange(width - size_px + 1)[None, :]
+        return self.window_means(name, rows, rows + size_px, cols, cols + size_px)
+
+    def extract_patch_statistics(self, patch_grid, layers=None):
+        layers = layers or self.layers
+        bounds = patch_grid.geometry.bounds
+        window = self.pixel_window(bounds['minx'].to_numpy(), bounds['miny'].to_numpy(),
+                                   bounds['maxx'].to_numpy(), bounds['maxy'].to_numpy())
+        for name in layers:
+            patch_grid[name] = self.window_means(name, *window)
+        filtered = patch_grid.dropna(subset=list(layers))
+        print(f"Extracted stats: {len(filtered)} valid patches / {len(patch_grid)} total")
+        return filtered
+
+    def patch_statistics(self, grid_size, offset_x=0.0, offset_y=0.0, layers=None):
+        # Grid + statistics for any patch size or origin shift without touching the rasters
+        patch_grid = grid.create_patch_grid(self, grid_size, offset_x=offset_x, offset_y=offset_y)
+        return self.extract_patch_statistics(patch_grid, layers)
+
+
+def _summed_area(arr):
+    table = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=arr.dtype)
+    np.cumsum(arr, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def _window_total(table, row_start, row_stop, col_start, col_stop):
+    return (table[row_stop, col_stop] - table[row_start, col_stop]
+            - table[row_stop, col_start] + table[row_start, col_start])
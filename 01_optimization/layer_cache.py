@@ -0,0 +1,120 @@
+# layer_cache.py
+import os
+import json
+import fcntl
+import time
+import shutil
+import hashlib
+from contextlib import contextmanager
+
+DEFAULT_CACHE_DIR = os.environ.get("GEE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "kaleidoscope", "gee"))
+DEFAULT_MAX_BYTES = int(float(os.environ.get("GEE_CACHE_MAX_MB", 2048)) * 1024 * 1024)
+
+
+def cache_key(center_lon, center_lat, buffer_km, crs, scale, layers_version, multiband=False):
+    # Coordinates rounded to ~1 cm so float noise from the coordinates table still hits
+    params = {
+        "center": [round(float(center_lon), 7), round(float(center_lat), 7)],
+        "buffer_km": float(buffer_km),
+        "crs": crs,
+        "scale": scale,
+        "layers": layers_version,
+    }
+    if multiband:
+        params["multiband"] = True
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+class LayerCache:
+    """
+    Content-addressed store of downloaded layer GeoTIFFs. Each entry lives in
+    <cache_dir>/<key>/ and is listed in index.json with its files, region GeoJSON,
+    size and last access time. Entries are evicted least-recently-used first
+    once the total size exceeds max_bytes. Index updates hold an exclusive lock on
+    index.lock, so concurrent pipeline runs never drop each other's entries.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock_path = os.path.join(cache_dir, "index.lock")
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_index(self, index):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, key, names=None):
+        # (files, region_geojson) for a complete entry, else None
+        with self._locked():
+            index = self._read_index()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            entry_dir = os.path.join(self.cache_dir, key)
+            files = {name: os.path.join(entry_dir, filename) for name, filename in entry["files"].items()}
+            if any(name not in files for name in names or []) or not all(map(os.path.exists, files.values())):
+                # Entry lost files on disk; drop it and refetch
+                self._remove(index, key)
+                self._write_index(index)
+                return None
+            entry["last_access"] = time.time()
+            self._write_index(index)
+            return files, entry["region"]
+
+    def put(self, key, files, region_geojson):
+        entry_dir = os.path.join(self.cache_dir, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        stored, size = {}, 0
+        for name, path in files.items():
+            filename = os.path.basename(path)
+            if filename not in stored.values():
+                # Layers of a multi-band stack share one file; copy then rename, as a
+                # concurrent run may be storing the same entry
+                tmp_path = os.path.join(entry_dir, f"{filename}.{os.getpid()}.tmp")
+                shutil.copy2(path, tmp_path)
+                os.replace(tmp_path, os.path.join(entry_dir, filename))
+                size += os.path.getsize(path)
+            stored[name] = filename
+
+        with self._locked():
+            index = self._read_index()
+            index[key] = {"files": stored, "region": region_geojson, "size": size,
+                          "created": time.time(), "last_access": time.time()}
+            self._evict(index, keep=key)
+            self._write_index(index)
+        print(f"💾 Cached {len(stored)} layers ({size / 1e6:.1f} MB) under {key[:12]}")
+
+    def _evict(self, index, keep=None):
+        total = sum(entry["size"] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index[key]["size"]
+            self._remove(index, key)
+            print(f"🧹 Evicted cached layers {key[:12]}")
+
+    def _remove(self, index, key):
+        index.pop(key, None)
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
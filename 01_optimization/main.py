@@ -30,6 +30,9 @@ def main():
     parser = argparse.ArgumentParser(description="Run NSGA-II Flood Mitigation Optimization")
     parser.add_argument("--buffer_km", type=int, default=10, help="Buffer radius in km")
     parser.add_argument("--output", type=str, default="05_results", help="Output folder")
+    parser.add_argument("--grid_size", type=int, default=1000, help="Patch size in map units")
+    parser.add_argument("--no_cache", action="store_true", help="Always re-download GEE layers")
+    parser.add_argument("--multiband", action="store_true", help="Fetch all layers as one multi-band GeoTIFF")
     args = parser.parse_args()
 
     print("\n🚀 Starting optimization pipeline...")
@@ -39,18 +42,20 @@ def main():
 
     # Step 1:  Authenticate and download GEE data
     files, region_geojson = gee_fetch.setup_data_automatically(
-        center_lon=center_lon, center_lat=center_lat, buffer_km=args.buffer_km, output_folder=args.output
+        center_lon=center_lon, center_lat=center_lat, buffer_km=args.buffer_km, output_folder=args.output,
+        cache=not args.no_cache, multiband=args.multiband
     )
 
-    # Step 2: Load and validate rasters
-    rasters = grid.load_and_check_rasters(files)
+    # Step 2: Load and validate rasters (decoded once, shared by grid and MCDA)
+    rasters = grid.load_raster_stack(files)
 
     # Step 3: Generate patch grid and extract stats
-    patch_grid = grid.create_patch_grid(rasters['study_area'], grid_size=1000)
-    valid_patches = grid.extract_patch_statistics(patch_grid, rasters)
+    patch_grid = grid.create_patch_grid(rasters['study_area'], grid_size=args.grid_size)
+    valid_patches = grid.extract_patch_statistics(patch_grid, rasters, statistics=grid.SITING_STATISTICS)
 
     # Step 4: Run MCDA to create composite suitability
-    composite, composite_norm = mcda.compute_composite(rasters)
+    composite, composite_norm, extent = mcda.compute_composite(rasters)
+    valid_patches['mcda_score'] = mcda.patch_scores(valid_patches, composite_norm, rasters['study_area'].transform)
 
     # Step 5: Run NSGA-II optimization
     _, raw_selected_patches = nsga.run_nsga_pipeline(valid_patches)
@@ -67,7 +72,7 @@ def main():
             print(f"⚠️ Unexpected patch format skipped: {type(p)}")
 
     # Step 6: Create DataFrame with results
-    results_df = create_results_dataframe(selected_patches, valid_patches)
+    results_df = create_results_dataframe(selected_patches, valid_patches, dedupe=True)
 
     # Step 7: Export results
     export_utils.save_results(results_df, selected_patches, valid_patches, output_dir=args.output)
@@ -89,7 +94,7 @@ def insert_top_patches_to_supabase(df):
     client = create_client(url, key)
 
     # Επιλέγουμε τα top 5
-    top5 = df.sort_values("overall_score", ascending=False).drop_duplicates("patch_id").head(5)
+    top5 = df.head(5)
 
     rows = []
     for _, row in top5.iterrows():
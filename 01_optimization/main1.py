@@ -2,8 +2,12 @@ import argparse
 import os
 import warnings
 import gee_fetch, grid, mcda
+from integral_index import IntegralIndex
+from raster_stack import layer_band, band_nodata
 import rasterio
 from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.shutil import copy as rio_copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from utils import get_latest_coordinates, get_supabase_client
 import subprocess
 import time
@@ -13,31 +17,67 @@ import numpy as np
 
 warnings.filterwarnings("ignore")
 
-def reproject_to_web_mercator(input_path, output_path):
+def reproject_to_web_mercator(input_path, output_path, layer=None, num_threads=2, blocksize=512):
+    """
+    Warp to EPSG:3857 with GDAL's multi-threaded warper into a tiled scratch file,
+    then copy it out as a Cloud-Optimized GeoTIFF: blocksize internal tiles,
+    DEFLATE with predictor, and nearest overviews halving until one block covers
+    the image, which is coarser than any zoom the tile server renders.
+    """
+    tmp_path = output_path + ".warp.tif"
     with rasterio.open(input_path) as src:
         transform, width, height = calculate_default_transform(
             src.crs, "EPSG:3857", src.width, src.height, *src.bounds)
 
         kwargs = src.meta.copy()
         kwargs.update({
+            "driver": "GTiff",
             "crs": "EPSG:3857",
             "transform": transform,
             "width": width,
-            "height": height
+            "height": height,
+            "tiled": True,
+            "blockxsize": blocksize,
+            "blockysize": blocksize,
+            "BIGTIFF": "IF_SAFER"
         })
-
-        with rasterio.open(output_path, "w", **kwargs) as dst:
-            for i in range(1, src.count + 1):
+        bands = range(1, src.count + 1)
+        if layer is not None and src.count > 1:
+            # One named layer of a multi-band stack becomes its own single-band file
+            bands = [layer_band(src, layer)]
+            kwargs.update({"count": 1, "nodata": band_nodata(src, bands[0])})
+
+        with rasterio.open(tmp_path, "w", **kwargs) as dst:
+            for i, band in enumerate(bands, 1):
                 reproject(
-                    source=rasterio.band(src, i),
+                    source=rasterio.band(src, band),
                     destination=rasterio.band(dst, i),
                     src_transform=src.transform,
                     src_crs=src.crs,
                     dst_transform=transform,
                     dst_crs="EPSG:3857",
-                    resampling=Resampling.nearest
+                    resampling=Resampling.nearest,
+                    num_threads=num_threads
                 )
-    print(f"🌍 Reprojected {input_path} ➜ {output_path}")
+
+    rio_copy(tmp_path, output_path, driver="COG", BLOCKSIZE=blocksize, COMPRESS="DEFLATE", PREDICTOR="YES",
+             OVERVIEWS="AUTO", OVERVIEW_RESAMPLING="NEAREST", NUM_THREADS=num_threads, BIGTIFF="IF_SAFER")
+    os.remove(tmp_path)
+    print(f"🌍 Reprojected {input_path} ➜ {output_path} (COG)")
+
+def reproject_layers_to_web_mercator(files, workers=None):
+    # All layers at once; GDAL releases the GIL, so threads warp in parallel
+    workers = workers or len(files)
+    num_threads = max(1, (os.cpu_count() or 1) // workers)
+    web_files = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for name, path in files.items():
+            web_files[name] = os.path.join(os.path.dirname(path), f"{name}_web.tif")
+            futures[executor.submit(reproject_to_web_mercator, path, web_files[name], name, num_threads)] = name
+        for future in as_completed(futures):
+            future.result()
+    return web_files
 
 def upload_rasters_to_supabase(files_dict, project_id):
     client = get_supabase_client()
@@ -86,6 +126,11 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--buffer_km", type=int, default=10)
     parser.add_argument("--output", type=str, default="05_results")
+    parser.add_argument("--low_memory", action="store_true", help="Stream MCDA over raster blocks")
+    parser.add_argument("--grid_size", type=int, default=1000, help="Patch size in map units")
+    parser.add_argument("--no_cache", action="store_true", help="Always re-download GEE layers")
+    parser.add_argument("--multiband", action="store_true", help="Fetch all layers as one multi-band GeoTIFF")
+    parser.add_argument("--workers", type=int, default=1, help="Processes for patch extraction")
     args = parser.parse_args()
 
     print("\n🔹 Step 1: GEE Fetch + Grid + MCDA")
@@ -96,15 +141,13 @@ def main():
         center_lon=center_lon,
         center_lat=center_lat,
         buffer_km=args.buffer_km,
-        output_folder=args.output
+        output_folder=args.output,
+        cache=not args.no_cache,
+        multiband=args.multiband
     )
 
-    # Reproject downloaded TIFFs to EPSG:3857 for web map use
-    web_files = {}
-    for name, path in files.items():
-        web_path = path.replace(".tif", "_web.tif")
-        reproject_to_web_mercator(path, web_path)
-        web_files[name] = web_path
+    # Reproject downloaded TIFFs to EPSG:3857 COGs for web map use
+    web_files = reproject_layers_to_web_mercator(files)
 
     # Fetch project_id from latest row
     client = get_supabase_client()
@@ -113,20 +156,38 @@ def main():
 
     upload_rasters_to_supabase(web_files, project_id)
 
-    rasters = grid.load_and_check_rasters(files)
+    if args.low_memory:
+        rasters = grid.load_and_check_rasters(files)
+    else:
+        rasters = grid.load_raster_stack(files)
 
-    patch_grid = grid.create_patch_grid(rasters["study_area"], grid_size=1000)
-    valid_patches = grid.extract_patch_statistics(patch_grid, rasters)
+    patch_grid = grid.create_patch_grid(rasters["study_area"], grid_size=args.grid_size)
+    if args.workers > 1:
+        valid_patches = grid.extract_patch_statistics_parallel(
+            patch_grid, files, workers=args.workers, statistics=grid.SITING_STATISTICS)
+    else:
+        valid_patches = grid.extract_patch_statistics(patch_grid, rasters, statistics=grid.SITING_STATISTICS)
 
-    # Export valid patches for next step
-    valid_path = os.path.join(args.output, "valid_patches.geojson")
-    valid_patches.to_file(valid_path, driver="GeoJSON")
-    print(f"📤 Saved valid patches to {valid_path}")
+    # Persist summed-area tables so other patch sizes/offsets can be queried without the rasters
+    if not args.low_memory:
+        IntegralIndex.build(rasters).save(os.path.join(args.output, "integral_index"))
 
     # Run MCDA and export composite (automatically handled in mcda)
-    composite, composite_norm, extent = mcda.compute_composite(rasters)
+    if args.low_memory:
+        composite, composite_norm, extent = mcda.compute_composite_windowed(rasters, RESULTS_DIR)
+    else:
+        # Keep the normalized stack so weights can be changed later without re-reading rasters
+        mcda.save_normalized_stack(rasters, RESULTS_DIR)
+        composite, composite_norm, extent = mcda.reweight_composite(RESULTS_DIR)
+
+
 
+    valid_patches["mcda_score"] = mcda.patch_scores(valid_patches, composite_norm, rasters["study_area"].transform)
 
+    # Export valid patches for next step
+    valid_path = os.path.join(args.output, "valid_patches.geojson")
+    valid_patches.to_file(valid_path, driver="GeoJSON")
+    print(f"📤 Saved valid patches to {valid_path}")
 
     print("✅ Preprocessing complete.")
 
@@ -150,8 +211,9 @@ def main():
     # Save valid_patches
     valid_patches.to_file(os.path.join(RESULTS_DIR, "valid_patches.geojson"), driver="GeoJSON")
 
-    # Save composite_norm
-    np.save(os.path.join(RESULTS_DIR, "composite_norm.npy"), composite_norm)
+    # Save composite_norm (already written by the windowed MCDA)
+    if not args.low_memory:
+        np.save(os.path.join(RESULTS_DIR, "composite_norm.npy"), composite_norm)
 
     # Ensure extent is float-serializable
     extent = {k: float(v) for k, v in extent.items()}
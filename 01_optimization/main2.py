@@ -3,7 +3,7 @@ import warnings
 import os
 import geopandas as gpd
 import pandas as pd
-from nsga import run_nsga_pipeline, create_results_dataframe
+from nsga import run_nsga_pipeline, run_exact_pareto, run_portfolio_pipeline, run_island_pipeline, create_results_dataframe, weighted_score
 import export_utils
 from supabase import create_client
 from datetime import datetime, timezone
@@ -14,6 +14,20 @@ warnings.filterwarnings("ignore")
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", type=str, default="05_results")
+    parser.add_argument("--mode", type=str, default="nsga", choices=["nsga", "exact", "portfolio", "islands"],
+                        help="NSGA-II search, exact Pareto front over all patches, k-patch portfolios, "
+                             "or island-model NSGA-II")
+    parser.add_argument("--k", type=int, default=5, help="Patches per portfolio (portfolio mode)")
+    parser.add_argument("--seed", type=int, default=None, help="Master seed for reproducible NSGA-II runs")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for independent NSGA-II runs")
+    parser.add_argument("--islands", type=int, default=4, help="Number of islands (islands mode)")
+    parser.add_argument("--migration_interval", type=int, default=5, help="Generations between migrations")
+    parser.add_argument("--topology", type=str, default="ring", choices=["ring", "full"],
+                        help="Island migration topology")
+    parser.add_argument("--early_stop_tol", type=float, default=None,
+                        help="Stop a run when hypervolume gains stay below this value")
+    parser.add_argument("--early_stop_patience", type=int, default=3,
+                        help="Generations without hypervolume gain before stopping")
     args = parser.parse_args()
 
     print("\n🔹 Step 2: NSGA-II Optimization")
@@ -24,13 +38,29 @@ def main():
     valid_path = os.path.join(args.output, "valid_patches.geojson")
     valid_patches = gpd.read_file(valid_path)
 
-    # Run NSGA-II
-    results_df, raw_selected = run_nsga_pipeline(valid_patches)
-
-    # Create full results dataframe
-    final_df = create_results_dataframe(raw_selected, valid_patches)
-
-    final_df = final_df.drop_duplicates(subset="patch_id", keep="first")
+    # Run NSGA-II or the exact non-dominated sort
+    if args.mode == "exact":
+        results_df, raw_selected = run_exact_pareto(valid_patches)
+    elif args.mode == "portfolio":
+        results_df, raw_selected = run_portfolio_pipeline(valid_patches, k=args.k, seed=args.seed)
+    elif args.mode == "islands":
+        results_df, raw_selected = run_island_pipeline(
+            valid_patches, n_islands=args.islands, migration_interval=args.migration_interval,
+            topology=args.topology, seed=args.seed, workers=args.workers
+        )
+    else:
+        early_stop = None
+        if args.early_stop_tol is not None:
+            early_stop = (args.early_stop_tol, args.early_stop_patience)
+        results_df, raw_selected = run_nsga_pipeline(
+            valid_patches, seed=args.seed, workers=args.workers, early_stop=early_stop,
+            convergence_log=os.path.join(args.output, "convergence_log.csv")
+        )
+
+    # Create full results dataframe, one row per patch; exact and portfolio modes
+    # order their picks by the weighted objectives, so keep that ranking
+    rank_key = weighted_score if args.mode in ("exact", "portfolio") else None
+    final_df = create_results_dataframe(raw_selected, valid_patches, dedupe=True, rank_key=rank_key)
 
     # Export to CSV + GeoJSON
     csv_path = os.path.join(args.output, "selected_patches.csv")
@@ -38,7 +68,7 @@ def main():
     print(f"📤 Saved CSV to {csv_path}")
 
     geojson_path = os.path.join(args.output, "selected_patches.geojson")
-    gdf = gpd.GeoDataFrame(final_df, geometry=valid_patches.geometry.iloc[final_df['patch_id']], crs=valid_patches.crs)
+    gdf = gpd.GeoDataFrame(final_df, geometry=valid_patches.geometry.iloc[final_df['patch_id'].to_numpy()].to_numpy(), crs=valid_patches.crs)
     gdf.to_file(geojson_path, driver="GeoJSON")
     print(f"📤 Saved GeoJSON to {geojson_path}")
 
@@ -58,7 +88,7 @@ def upload_to_supabase(df):
     table = os.environ.get("SUPABASE_RESULTS_TABLE", "results")
     client = create_client(url, key)
 
-    top10 = df.sort_values("overall_score", ascending=False).drop_duplicates("patch_id").head(10)
+    top10 = df.head(10)
 
     rows = []
     for _, row in top10.iterrows():
@@ -1,33 +1,68 @@
 # mcda.py
+import os
+import json
 import numpy as np
+import rasterio
 from sklearn.preprocessing import MinMaxScaler
 from rasterio.transform import array_bounds
+from raster_stack import StackLayer
+import grid
+
+DEFAULT_LAYERS = ['slope', 'landcoverSuitability', 'soil', 'urbanProximity', 'floodRisk']
+
+
+def _default_weights():
+    raw_weights = np.array([1, 1, 1, 1, 2], dtype=float)  # floodRisk gets double weight
+    return raw_weights / raw_weights.sum()
+
+
+def _extent(height, width, transform):
+    bounds = array_bounds(height, width, transform)
+    return {
+        "minx": float(bounds[0]),
+        "miny": float(bounds[1]),
+        "maxx": float(bounds[2]),
+        "maxy": float(bounds[3])
+    }
+
+
+def _normalized_layer(src):
+    arr = src.read(1).astype(float)
+    if src.nodata is not None:
+        arr[arr == src.nodata] = np.nan
+    if isinstance(src, StackLayer):
+        # RasterStack layers already carry min/max from their single decode
+        stats = src.stats
+        value_range = stats['max'] - stats['min']
+        return (arr - stats['min']) / (value_range if value_range > 0 else 1.0)
+    flat = arr.flatten()
+    valid = ~np.isnan(flat)
+    scaled = np.full(flat.shape, np.nan)
+    if valid.any():
+        scaler = MinMaxScaler()
+        scaled[valid] = scaler.fit_transform(flat[valid].reshape(-1, 1)).flatten()
+    return scaled.reshape(arr.shape)
+
+
+def _study_area_mask(rasters, shape):
+    if 'study_area' not in rasters:
+        return np.ones(shape, dtype=bool)
+    study_area = rasters['study_area']
+    if isinstance(study_area, StackLayer):
+        return study_area.valid
+    return study_area.read(1) != study_area.nodata
 
 
 def compute_composite(rasters, layer_names=None, weights=None):
     if layer_names is None:
-        layer_names = ['slope', 'landcoverSuitability', 'soil', 'urbanProximity', 'floodRisk']
+        layer_names = DEFAULT_LAYERS
     if weights is None:
-        raw_weights = np.array([1, 1, 1, 1, 2], dtype=float)  # floodRisk gets double weight
-        weights = raw_weights / raw_weights.sum()
+        weights = _default_weights()
 
     print("\n🧮 Running MCDA with layers:", layer_names)
     print("Weights:", dict(zip(layer_names, weights)))
 
-    normalized_layers = []
-    for name in layer_names:
-        src = rasters[name]
-        arr = src.read(1).astype(float)
-        if src.nodata is not None:
-            arr[arr == src.nodata] = np.nan
-        flat = arr.flatten()
-        valid = ~np.isnan(flat)
-        scaled = np.full(flat.shape, np.nan)
-        if valid.any():
-            scaler = MinMaxScaler()
-            scaled[valid] = scaler.fit_transform(flat[valid].reshape(-1, 1)).flatten()
-        norm_arr = scaled.reshape(arr.shape)
-        normalized_layers.append(norm_arr)
+    normalized_layers = [_normalized_layer(rasters[name]) for name in layer_names]
 
     stack = np.stack(normalized_layers)
     composite = np.zeros_like(stack[0], dtype=float)
@@ -35,22 +70,141 @@ def compute_composite(rasters, layer_names=None, weights=None):
         composite += weights[i] * np.nan_to_num(layer, nan=0)
 
     if 'study_area' in rasters:
-        mask_arr = rasters['study_area'].read(1)
-        nodata_val = rasters['study_area'].nodata
-        composite = np.where(mask_arr != nodata_val, composite, np.nan)
+        composite = np.where(_study_area_mask(rasters, composite.shape), composite, np.nan)
 
     composite_norm = (composite - np.nanmin(composite)) / (np.nanmax(composite) - np.nanmin(composite))
     print("✅ Composite suitability map computed")
 
     # Calculate extent properly
     height, width = composite_norm.shape
-    transform = rasters[layer_names[0]].transform
-    bounds = array_bounds(height, width, transform)
-    extent = {
-        "minx": float(bounds[0]),
-        "miny": float(bounds[1]),
-        "maxx": float(bounds[2]),
-        "maxy": float(bounds[3])
-    }
+    extent = _extent(height, width, rasters[layer_names[0]].transform)
+
+    return composite, composite_norm, extent
+
+
+def patch_scores(patch_grid, composite_norm, transform):
+    # Per-patch MCDA score: mean of the normalized composite over each patch's pixels,
+    # using the same pixel->patch labels as grid's zonal extraction
+    labels = grid.patch_labels(patch_grid, transform, composite_norm.shape)
+    scores = grid._zonal_statistics(np.asarray(composite_norm, dtype=float), None, labels, len(patch_grid))
+    print(f"✅ MCDA scores computed for {len(patch_grid)} patches")
+    return scores['mean']
+
+
+def save_normalized_stack(rasters, output_dir, layer_names=None):
+    # Persist the normalized layers (nodata as 0, as the composite treats them) and the
+    # study-area mask so weights can be changed later without decoding the rasters.
+    if layer_names is None:
+        layer_names = DEFAULT_LAYERS
+    os.makedirs(output_dir, exist_ok=True)
+    ref = rasters[layer_names[0]]
+    height, width = ref.shape
+
+    stack = np.lib.format.open_memmap(os.path.join(output_dir, "normalized_stack.npy"), mode="w+",
+                                      dtype=np.float32, shape=(len(layer_names), height, width))
+    for i, name in enumerate(layer_names):
+        stack[i] = np.nan_to_num(_normalized_layer(rasters[name]), nan=0)
+    stack.flush()
+    np.save(os.path.join(output_dir, "normalized_mask.npy"), _study_area_mask(rasters, (height, width)))
+
+    with open(os.path.join(output_dir, "normalized_stack.json"), "w") as f:
+        json.dump({"layers": list(layer_names), "extent": _extent(height, width, ref.transform)}, f, indent=2)
+    print(f"💾 Saved normalized layer stack to {output_dir}")
+
+
+def reweight_composite(stack_dir, weights=None):
+    # Composite from the persisted stack: one tensordot, no GeoTIFF decode or scaling.
+    # weights: {layer: weight} or a sequence in the stack's layer order.
+    with open(os.path.join(stack_dir, "normalized_stack.json")) as f:
+        meta = json.load(f)
+    layer_names = meta["layers"]
+    if weights is None:
+        weights = _default_weights()
+    elif isinstance(weights, dict):
+        weights = [weights.get(name, 0.0) for name in layer_names]
+    weights = np.asarray(weights, dtype=np.float32)
+
+    stack = np.load(os.path.join(stack_dir, "normalized_stack.npy"), mmap_mode="r")
+    inside = np.load(os.path.join(stack_dir, "normalized_mask.npy"))
+    composite = np.tensordot(weights, stack, axes=1).astype(float)
+    composite[~inside] = np.nan
+
+    composite_norm = (composite - np.nanmin(composite)) / (np.nanmax(composite) - np.nanmin(composite))
+    print("✅ Composite re-weighted:", dict(zip(layer_names, weights.tolist())))
+    return composite, composite_norm, meta["extent"]
+
+
+def _read_window(src, window):
+    arr = src.read(1, window=window).astype(float)
+    if src.nodata is not None:
+        arr[arr == src.nodata] = np.nan
+    return arr
+
+
+def compute_composite_windowed(rasters, output_dir, layer_names=None, weights=None):
+    # Same (composite, composite_norm, extent) as compute_composite, but streamed over
+    # the block windows of the first layer so peak memory is bounded by block size
+    # rather than region size. Both arrays are float32 read-only memmaps of
+    # composite.npy and composite_norm.npy; composite.tif is also written to output_dir.
+    if layer_names is None:
+        layer_names = DEFAULT_LAYERS
+    if weights is None:
+        weights = _default_weights()
+    os.makedirs(output_dir, exist_ok=True)
+
+    print("\n🧮 Running windowed MCDA with layers:", layer_names)
+    print("Weights:", dict(zip(layer_names, weights)))
+
+    ref = rasters[layer_names[0]]
+    windows = [window for _, window in ref.block_windows(1)]
+
+    # Pass 1: per-layer min/max
+    layer_min = np.full(len(layer_names), np.inf)
+    layer_max = np.full(len(layer_names), -np.inf)
+    for window in windows:
+        for i, name in enumerate(layer_names):
+            arr = _read_window(rasters[name], window)
+            if not np.isnan(arr).all():
+                layer_min[i] = min(layer_min[i], np.nanmin(arr))
+                layer_max[i] = max(layer_max[i], np.nanmax(arr))
+    layer_range = layer_max - layer_min
+    layer_range[~(layer_range > 0)] = 1.0  # constant layers scale to 0, as MinMaxScaler does
+
+    # Pass 2: weighted composite, written window by window
+    composite_path = os.path.join(output_dir, "composite.tif")
+    profile = ref.profile.copy()
+    profile.update(driver="GTiff", count=1, dtype="float32", nodata=np.nan,
+                   tiled=True, blockxsize=256, blockysize=256)
+    mask_src = rasters.get('study_area')
+    comp_min, comp_max = np.inf, -np.inf
+    raw_path = os.path.join(output_dir, "composite.npy")
+    composite_raw = np.lib.format.open_memmap(raw_path, mode="w+", dtype=np.float32, shape=ref.shape)
+    with rasterio.open(composite_path, "w", **profile) as dst:
+        for window in windows:
+            composite = np.zeros((int(window.height), int(window.width)))
+            for i, name in enumerate(layer_names):
+                norm = (_read_window(rasters[name], window) - layer_min[i]) / layer_range[i]
+                composite += weights[i] * np.nan_to_num(norm, nan=0)
+            if mask_src is not None:
+                mask_arr = mask_src.read(1, window=window)
+                composite[mask_arr == mask_src.nodata] = np.nan
+            if not np.isnan(composite).all():
+                comp_min = min(comp_min, np.nanmin(composite))
+                comp_max = max(comp_max, np.nanmax(composite))
+            dst.write(composite.astype(np.float32), 1, window=window)
+            row, col = int(window.row_off), int(window.col_off)
+            composite_raw[row:row + composite.shape[0], col:col + composite.shape[1]] = composite
+    composite_raw.flush()
+
+    # Pass 3: rescale into a memory-mapped composite_norm.npy
+    norm_path = os.path.join(output_dir, "composite_norm.npy")
+    composite_norm = np.lib.format.open_memmap(norm_path, mode="w+", dtype=np.float32, shape=ref.shape)
+    for window in windows:
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        block = composite_raw[row_start:row_stop, col_start:col_stop].astype(float)
+        composite_norm[row_start:row_stop, col_start:col_stop] = (block - comp_min) / (comp_max - comp_min)
+    composite_norm.flush()
+    print(f"✅ Composite suitability map written to {composite_path} and {norm_path}")
 
-    return composite, composite_norm, extent
\ No newline at end of file
+    extent = _extent(ref.height, ref.width, ref.transform)
+    return np.load(raw_path, mmap_mode="r"), np.load(norm_path, mmap_mode="r"), extent
\ No newline at end of file
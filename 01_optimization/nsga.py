@@ -1,113 +1,612 @@
 # nsga.py
-from deap import base, creator, tools
-from sklearn.preprocessing import MinMaxScaler
+from deap import base, creator
 import numpy as np
-import random
-from scipy.spatial.distance import cdist
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from scipy.spatial import cKDTree
 import pandas as pd
+import geopandas as gpd
 
 # NSGA parameters
-def run_nsga_pipeline(valid_patches, pop_size=100, generations=20, num_runs=5, min_distance=1000, num_to_select=5):
+def run_nsga_pipeline(valid_patches, pop_size=100, generations=20, num_runs=5, min_distance=1000, num_to_select=5,
+                      extra_objectives=None, constraints=None, mcda_seed_fraction=0.0, seed=None, workers=None,
+                      early_stop=None, convergence_log=None):
+    # extra_objectives: {column: weight} added to the five layer objectives, e.g. {'floodRisk_p90': 1.0}
+    # constraints: {column: (min, max)}; patches outside the bounds get a dominated fitness
+    # mcda_seed_fraction: share of each initial population taken from the top 'mcda_score' patches
+    # seed: master seed; every run gets its own generator derived from it, so results are reproducible
+    # workers: processes for the independent runs (default: one per run, capped at the CPU count)
+    # early_stop: (min_hypervolume_gain, patience) to end a run once its front stops improving
+    # convergence_log: CSV path for per-generation hypervolume, front size, unique patches, evals/s
     print("\n🤖 Running NSGA-II optimization")
 
-    objective_cols = ['landcoverSuitability', 'slope', 'soil', 'floodRisk', 'urbanProximity']
-    scaler = MinMaxScaler()
-    valid_patches[objective_cols] = scaler.fit_transform(valid_patches[objective_cols])
+    objective_cols, objective_weights, feasible = _prepare_objectives(valid_patches, extra_objectives, constraints)
+    _create_types(objective_weights)
+    objectives = objective_matrix(valid_patches, objective_cols, objective_weights, feasible)
 
-    creator.create("FitnessMulti", base.Fitness, weights=(1.0, 1.0, 1.0, 3.0, 1.0))
-    creator.create("Individual", list, fitness=creator.FitnessMulti)
-    toolbox = base.Toolbox()
-    toolbox.register("indices", random.randint, 0, len(valid_patches) - 1)
-    toolbox.register("individual", tools.initRepeat, creator.Individual, toolbox.indices, n=1)
-    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+    mcda_seeds = []
+    if mcda_seed_fraction > 0 and 'mcda_score' in valid_patches:
+        n_seeds = int(pop_size * mcda_seed_fraction)
+        mcda_seeds = np.argsort(-valid_patches['mcda_score'].to_numpy(), kind='stable')[:n_seeds].tolist()
 
-    def evaluate(ind, data):
-        idx = ind[0]
-        row = data.iloc[idx]
-        return tuple(row[col] for col in objective_cols)
+    optimizer = NSGAOptimizer(objectives, objective_weights, pop_size=pop_size)
+    run_seeds = np.random.SeedSequence(seed).spawn(num_runs)
+    workers = min(workers or os.cpu_count() or 1, num_runs)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            populations = list(pool.map(optimizer.run, [generations] * num_runs, run_seeds,
+                                        [mcda_seeds] * num_runs, [early_stop] * num_runs,
+                                        [bool(convergence_log)] * num_runs))
+    else:
+        populations = [optimizer.run(generations, run_seed, mcda_seeds, early_stop, bool(convergence_log))
+                       for run_seed in run_seeds]
 
-    toolbox.register("evaluate", evaluate, data=valid_patches)
-    toolbox.register("mate", lambda ind1, ind2: (creator.Individual([ind2[0]]), creator.Individual([ind1[0]])))
-    toolbox.register("mutate", lambda ind: (creator.Individual([random.randint(0, len(valid_patches) - 1)]),))
-    toolbox.register("select", tools.selNSGA2)
+    if convergence_log:
+        log = pd.DataFrame([{'run': run + 1, **row}
+                            for run, (_, _, history) in enumerate(populations) for row in history])
+        log.to_csv(convergence_log, index=False, float_format="%.6g")
+        print(f"📈 Saved convergence log to {convergence_log}")
 
+    centroids = valid_patches[['centroid_x', 'centroid_y']].to_numpy(dtype=float)
     all_selected = []
-    for run in range(num_runs):
-        print(f"\n▶ Run {run+1} of {num_runs}")
-        pop = toolbox.population(n=pop_size)
-        for ind in pop:
-            ind.fitness.values = toolbox.evaluate(ind)
-        for gen in range(generations):
-            offspring = toolbox.select(pop, len(pop))
-            offspring = list(map(toolbox.clone, offspring))
-            for i in range(1, len(offspring), 2):
-                if random.random() < 0.7:
-                    offspring[i - 1], offspring[i] = toolbox.mate(offspring[i - 1], offspring[i])
-                    del offspring[i - 1].fitness.values, offspring[i].fitness.values
-            for i in range(len(offspring)):
-                if random.random() < 0.3:
-                    offspring[i], = toolbox.mutate(offspring[i])
-                    del offspring[i].fitness.values
-            invalid = [ind for ind in offspring if not ind.fitness.valid]
-            for ind in invalid:
-                ind.fitness.values = toolbox.evaluate(ind)
-            pop[:] = offspring
-
-        selected = select_spatially_distributed(pop, valid_patches, min_distance, num_to_select)
+    for run, (indices, fitness, history) in enumerate(populations):
+        if history:
+            print(f"\n▶ Run {run+1} of {num_runs}: {history[-1]['generation']} generations, "
+                  f"hypervolume={history[-1]['hypervolume']:.4f}")
+        else:
+            print(f"\n▶ Run {run+1} of {num_runs}")
+        pop = []
+        for idx, values in zip(indices.tolist(), fitness.tolist()):
+            ind = creator.Individual([idx])
+            ind.fitness.values = tuple(values)
+            pop.append(ind)
+        selected = select_spatially_distributed(pop, valid_patches, min_distance, num_to_select, centroids=centroids)
         all_selected.extend(selected)
 
     results = summarize_results(all_selected, valid_patches)
     return results, all_selected
 
 
-def select_spatially_distributed(pop, df, min_dist, n):
+class NSGAOptimizer:
+    """
+    NSGA-II over single-patch genomes, built once and reusable across runs.
+    The population is an int array of patch indices; fitness is a fancy index into
+    the weighted objective matrix, and crossover, mutation and (mu + lambda)
+    survival via nsga2_select are array operations. No DEAP objects are cloned.
+    """
+
+    def __init__(self, objectives, objective_weights, pop_size=100, cx_prob=0.7, mut_prob=0.3, hv_samples=10000):
+        self.objectives = objectives
+        self.wobjectives = objectives * np.asarray(objective_weights, dtype=float)
+        self.pop_size = pop_size
+        self.cx_prob = cx_prob
+        self.mut_prob = mut_prob
+        # Objectives rescaled to the unit box (all maximized) for hypervolume; the same
+        # fixed sample points are reused every generation so estimates are comparable
+        oriented = objectives * np.sign(objective_weights)
+        low, high = oriented.min(axis=0), oriented.max(axis=0)
+        self.unit_objectives = (oriented - low) / np.where(high > low, high - low, 1.0)
+        self.hv_samples = np.random.default_rng(0).random((hv_samples, objectives.shape[1]))
+
+    def metrics(self, pop):
+        unique = np.unique(pop)
+        front = unique[non_dominated_fronts(self.wobjectives[unique], 1)[0]]
+        return {
+            'hypervolume': hypervolume(self.unit_objectives[front], self.hv_samples),
+            'front_size': len(front),
+            'unique_patches': len(unique),
+        }
+
+    def initial_population(self, rng, initial=()):
+        pop = rng.integers(0, len(self.objectives), self.pop_size)
+        initial = np.asarray(initial, dtype=np.int64)[:self.pop_size]
+        pop[:len(initial)] = initial
+        return pop
+
+    def step(self, pop, rng):
+        # One generation: variation on a shuffled copy, then (mu + lambda) survival
+        offspring = pop[rng.permutation(len(pop))]
+        # Pairwise crossover: single-gene genomes exchange their patch (pairs is a view)
+        pairs = offspring[:len(pop) - len(pop) % 2].reshape(-1, 2)
+        swap = rng.random(len(pairs)) < self.cx_prob
+        pairs[swap] = pairs[swap][:, ::-1]
+        mutate = rng.random(len(pop)) < self.mut_prob
+        offspring[mutate] = rng.integers(0, len(self.objectives), mutate.sum())
+
+        combined = np.concatenate([pop, offspring])
+        return combined[nsga2_select(self.wobjectives[combined], len(pop))]
+
+    def run(self, generations, seed=None, initial=(), early_stop=None, record=False):
+        # Returns the final population as (patch indices, unweighted fitness rows) and a
+        # per-generation metrics list (filled when record or early_stop is set).
+        # early_stop=(min_improvement, patience) ends the run once hypervolume gains stay
+        # below min_improvement for patience generations.
+        record = record or early_stop is not None
+        rng = np.random.default_rng(seed)
+        pop = self.initial_population(rng, initial)
+
+        history = [{'generation': 0, **self.metrics(pop), 'evals_per_sec': np.nan}] if record else []
+        stalled = 0
+        for gen in range(1, generations + 1):
+            start = time.perf_counter()
+            pop = self.step(pop, rng)
+            elapsed = time.perf_counter() - start
+            if not record:
+                continue
+
+            history.append({'generation': gen, **self.metrics(pop),
+                            'evals_per_sec': self.pop_size / elapsed if elapsed > 0 else np.nan})
+            if early_stop is not None:
+                min_improvement, patience = early_stop
+                gain = history[-1]['hypervolume'] - history[-2]['hypervolume']
+                stalled = stalled + 1 if gain < min_improvement else 0
+                if stalled >= patience:
+                    break
+
+        return pop, self.objectives[pop], history
+
+
+def run_island_pipeline(valid_patches, n_islands=4, pop_size=100, generations=20, migration_interval=5,
+                        migrants=5, topology="ring", min_distance=1000, num_to_select=5,
+                        extra_objectives=None, constraints=None, seed=None, workers=None):
+    # Island-model NSGA-II: islands evolve in worker processes for migration_interval
+    # generations at a time, then exchange their best individuals over a "ring" or "full"
+    # topology. Each island plays the role of one run in run_nsga_pipeline's output.
+    print(f"\n🏝️ Running island NSGA-II ({n_islands} islands, {topology} topology)")
+    if topology not in ("ring", "full"):
+        raise ValueError(f"Unknown migration topology: {topology}")
+    if migrants < 0:
+        raise ValueError(f"migrants must be >= 0, got {migrants}")
+
+    objective_cols, objective_weights, feasible = _prepare_objectives(valid_patches, extra_objectives, constraints)
+    _create_types(objective_weights)
+    optimizer = NSGAOptimizer(objective_matrix(valid_patches, objective_cols, objective_weights, feasible),
+                              objective_weights, pop_size=pop_size)
+
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_islands)]
+    pops = [optimizer.initial_population(rng) for rng in rngs]
+    workers = min(workers or os.cpu_count() or 1, n_islands)
+
+    # Workers receive the optimizer once; each epoch only ships index arrays and generator state
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_island_worker, initargs=(optimizer,)) \
+        if workers > 1 else None
+    _init_island_worker(optimizer)
+    try:
+        done = 0
+        while done < generations:
+            epoch = min(migration_interval, generations - done)
+            if pool is not None:
+                results = list(pool.map(_evolve_island, pops, rngs, [epoch] * n_islands))
+            else:
+                results = [_evolve_island(pop, rng, epoch) for pop, rng in zip(pops, rngs)]
+            pops = [pop for pop, _ in results]
+            rngs = [rng for _, rng in results]
+            done += epoch
+            if done < generations and n_islands > 1 and migrants > 0:
+                pops = _migrate(optimizer, pops, migrants, topology)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    centroids = valid_patches[['centroid_x', 'centroid_y']].to_numpy(dtype=float)
+    all_selected = []
+    for island, pop in enumerate(pops):
+        print(f"\n▶ Island {island+1} of {n_islands}")
+        individuals = []
+        for idx, values in zip(pop.tolist(), optimizer.objectives[pop].tolist()):
+            ind = creator.Individual([idx])
+            ind.fitness.values = tuple(values)
+            individuals.append(ind)
+        all_selected.extend(select_spatially_distributed(individuals, valid_patches, min_distance,
+                                                         num_to_select, centroids=centroids))
+
+    results = summarize_results(all_selected, valid_patches)
+    return results, all_selected
+
+
+_island_optimizer = None
+
+
+def _init_island_worker(optimizer):
+    global _island_optimizer
+    _island_optimizer = optimizer
+
+
+def _evolve_island(pop, rng, generations):
+    for _ in range(generations):
+        pop = _island_optimizer.step(pop, rng)
+    return pop, rng
+
+
+def _migrate(optimizer, pops, migrants, topology):
+    # Each island sends its best `migrants` (NSGA-II order) to its neighbours; receivers
+    # keep the best pop_size of residents plus immigrants
+    emigrants = [pop[nsga2_select(optimizer.wobjectives[pop], min(migrants, len(pop)))] for pop in pops]
+    n = len(pops)
+    migrated = []
+    for i, pop in enumerate(pops):
+        sources = [(i - 1) % n] if topology == "ring" else [j for j in range(n) if j != i]
+        combined = np.concatenate([pop] + [emigrants[j] for j in sources])
+        migrated.append(combined[nsga2_select(optimizer.wobjectives[combined], len(pop))])
+    return migrated
+
+
+def hypervolume(points, samples):
+    # Share of the unit box dominated by points (maximization), estimated on fixed samples.
+    # Only samples not yet dominated are tested against each further point.
+    remaining = np.ascontiguousarray(samples.T)
+    for p in points[np.argsort(-points.sum(axis=1))]:
+        inside = remaining[0] <= p[0]
+        for j in range(1, len(p)):
+            inside &= remaining[j] <= p[j]
+        remaining = remaining[:, ~inside]
+    return 1.0 - remaining.shape[1] / len(samples)
+
+
+def run_exact_pareto(valid_patches, min_distance=1000, num_to_select=5, extra_objectives=None, constraints=None):
+    # Each genome is a single patch, so the Pareto front is the non-dominated set of the
+    # patch table itself. Returns the same (results, selected individuals) as run_nsga_pipeline.
+    print("\n🎯 Computing exact Pareto front")
+
+    objective_cols, objective_weights, feasible = _prepare_objectives(valid_patches, extra_objectives, constraints)
+    _create_types(objective_weights)
+    objectives = objective_matrix(valid_patches, objective_cols, objective_weights)
+    candidates = np.flatnonzero(feasible)
+    oriented = objectives[candidates] * np.sign(objective_weights)
+
+    # Peel successive fronts until enough spatially separated patches are found
+    centroids = valid_patches[['centroid_x', 'centroid_y']].to_numpy(dtype=float)
+    pool, selected, n_fronts = [], [], 0
+    remaining = np.arange(len(candidates))
+    while remaining.size and len(selected) < num_to_select:
+        front = remaining[non_dominated(oriented[remaining])]
+        remaining = np.setdiff1d(remaining, front, assume_unique=True)
+        n_fronts += 1
+        for idx in candidates[front].tolist():
+            ind = creator.Individual([idx])
+            ind.fitness.values = tuple(objectives[idx].tolist())
+            pool.append(ind)
+        selected = select_spatially_distributed(pool, valid_patches, min_distance, num_to_select,
+                                                key=weighted_score, centroids=centroids)
+    print(f"Used {n_fronts} Pareto front(s) with {len(pool)} patches")
+
+    results = summarize_results(selected, valid_patches)
+    return results, selected
+
+
+def run_portfolio_pipeline(valid_patches, k=5, pop_size=100, generations=20, min_distance=1000,
+                           min_total_area=None, max_total_area=None, extra_objectives=None, constraints=None,
+                           seed=None):
+    # Genome = a set of k distinct patch indices. Fitness is the mean of the members'
+    # objectives; separation and total-area limits are enforced as penalties in the GA.
+    # Every random draw comes from one generator, so a seed reproduces the portfolio.
+    print(f"\n🧩 Running portfolio NSGA-II (k={k})")
+
+    objective_cols, objective_weights, feasible = _prepare_objectives(valid_patches, extra_objectives, constraints)
+    _create_types(objective_weights)
+    n_patches = len(valid_patches)
+    if n_patches < k:
+        raise ValueError(f"Need at least {k} patches for a portfolio, got {n_patches}")
+
+    evaluate = PortfolioEvaluator(
+        objective_matrix(valid_patches, objective_cols, objective_weights, feasible),
+        valid_patches[['centroid_x', 'centroid_y']].to_numpy(dtype=float),
+        valid_patches.geometry.area.to_numpy(),
+        objective_weights, min_distance, min_total_area, max_total_area
+    )
+
+    rng = np.random.default_rng(seed)
+
+    def sample(population, n):
+        return rng.choice(population, n, replace=False).tolist()
+
+    def mate(ind1, ind2):
+        union = sorted(set(ind1) | set(ind2))
+        return creator.Individual(sample(union, k)), creator.Individual(sample(union, k))
+
+    def mutate(ind):
+        members = set(ind)
+        new = int(rng.integers(n_patches))
+        while new in members:
+            new = int(rng.integers(n_patches))
+        ind[int(rng.integers(k))] = new
+        return ind,
+
+    pop = [creator.Individual(sample(n_patches, k)) for _ in range(pop_size)]
+    evaluate(pop)
+    for gen in range(generations):
+        offspring = []
+        for i in rng.permutation(len(pop)):
+            parent = pop[i]
+            child = creator.Individual(parent)
+            child.fitness.values = parent.fitness.values
+            offspring.append(child)
+        for i in range(1, len(offspring), 2):
+            if rng.random() < 0.7:
+                offspring[i - 1], offspring[i] = mate(offspring[i - 1], offspring[i])
+        for i in range(len(offspring)):
+            if rng.random() < 0.3:
+                offspring[i], = mutate(offspring[i])
+                del offspring[i].fitness.values
+        evaluate([ind for ind in offspring if not ind.fitness.valid])
+        combined = pop + offspring
+        survivors = nsga2_select(np.array([ind.fitness.wvalues for ind in combined]), pop_size)
+        pop = [combined[i] for i in survivors]
+
+    best = max(pop, key=weighted_score)
+    print(f"✅ Best portfolio {sorted(best)} (feasible={evaluate.is_feasible(best)})")
+
+    objectives = evaluate.objectives
+    selected = []
+    for idx in best:
+        ind = creator.Individual([idx])
+        ind.fitness.values = tuple(objectives[idx].tolist())
+        selected.append(ind)
+    selected.sort(key=weighted_score, reverse=True)
+    results = summarize_results(selected, valid_patches)
+    return results, selected
+
+
+class PortfolioEvaluator:
+    """
+    Evaluates a whole population of k-patch portfolios at once from precomputed
+    objective, centroid and area arrays.
+    """
+
+    def __init__(self, objectives, centroids, areas, objective_weights, min_distance,
+                 min_total_area=None, max_total_area=None):
+        self.objectives = objectives
+        self.centroids = centroids
+        self.areas = areas
+        self.worst = -np.sign(objective_weights)
+        self.min_distance = min_distance
+        self.min_total_area = min_total_area
+        self.max_total_area = max_total_area
+
+    def violation(self, members):
+        # Relative constraint violation per portfolio, 0 when feasible
+        pts = self.centroids[members]
+        diff = pts[:, :, None, :] - pts[:, None, :, :]
+        dist = np.sqrt((diff ** 2).sum(axis=-1))
+        k = members.shape[1]
+        dist[:, np.arange(k), np.arange(k)] = np.inf
+        violation = np.zeros(len(members))
+        if self.min_distance and k > 1:
+            violation += np.maximum(self.min_distance - dist.min(axis=(1, 2)), 0) / self.min_distance
+        area = self.areas[members].sum(axis=1)
+        if self.min_total_area:
+            violation += np.maximum(self.min_total_area - area, 0) / self.min_total_area
+        if self.max_total_area:
+            violation += np.maximum(area - self.max_total_area, 0) / self.max_total_area
+        return violation
+
+    def is_feasible(self, ind):
+        return bool(self.violation(np.array([ind]))[0] == 0)
+
+    def __call__(self, individuals):
+        if not individuals:
+            return
+        members = np.array(individuals, dtype=np.int64)
+        fitness = self.objectives[members].mean(axis=1)
+        violation = self.violation(members)
+        # Infeasible portfolios sit below every feasible one, ordered by how badly they violate
+        infeasible = violation > 0
+        fitness[infeasible] = self.worst * (1.0 + violation[infeasible, None])
+        for ind, values in zip(individuals, fitness.tolist()):
+            ind.fitness.values = tuple(values)
+
+
+def nsga2_select(wvalues, k):
+    """
+    Array version of tools.selNSGA2: positions of the k survivors given weighted
+    fitness values (n, n_objectives), filling whole fronts and breaking the last
+    one by crowding distance.
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    fronts = non_dominated_fronts(wvalues, k)
+    chosen = np.concatenate(fronts[:-1]) if len(fronts) > 1 else np.empty(0, dtype=np.int64)
+    last = fronts[-1]
+    if len(chosen) + len(last) > k:
+        crowding = crowding_distance(wvalues[last])
+        last = last[np.argsort(-crowding, kind="stable")[:k - len(chosen)]]
+    return np.concatenate([chosen, last]).astype(np.int64)
+
+
+def non_dominated_fronts(points, k=None):
+    # Successive Pareto fronts (all objectives maximized) until at least k points are covered
+    n = len(points)
+    k = n if k is None else k
+    dominates = np.ones((n, n), dtype=bool)
+    strictly = np.zeros((n, n), dtype=bool)
+    for column in points.T:
+        dominates &= column[:, None] >= column[None, :]
+        strictly |= column[:, None] > column[None, :]
+    dominates &= strictly
+    dominated_count = dominates.sum(axis=0)
+    assigned = np.zeros(n, dtype=bool)
+    fronts, covered = [], 0
+    while covered < k:
+        front = np.flatnonzero((dominated_count == 0) & ~assigned)
+        if not front.size:
+            break
+        fronts.append(front)
+        assigned[front] = True
+        covered += len(front)
+        dominated_count -= dominates[front].sum(axis=0)
+    return fronts
+
+
+def crowding_distance(points):
+    n, m = points.shape
+    distance = np.zeros(n)
+    if n <= 2:
+        distance[:] = np.inf
+        return distance
+    for j in range(m):
+        order = np.argsort(points[:, j], kind="stable")
+        values = points[order, j]
+        distance[order[[0, -1]]] = np.inf
+        span = values[-1] - values[0]
+        if span > 0:
+            distance[order[1:-1]] += (values[2:] - values[:-2]) / span
+    return distance
+
+
+def non_dominated(points):
+    """
+    Positions of the non-dominated rows of points (all objectives maximized).
+    Rows are visited in descending lexicographic order, so any dominating row is
+    already in the front when a row is tested; each test is vectorized over the front.
+    """
+    order = np.lexsort(points.T[::-1])[::-1]
+    front = np.empty_like(points)
+    keep = []
+    for i in order:
+        p = points[i]
+        current = front[:len(keep)]
+        if ((current >= p).all(axis=1) & (current > p).any(axis=1)).any():
+            continue
+        front[len(keep)] = p
+        keep.append(i)
+    return np.sort(np.array(keep, dtype=np.int64))
+
+
+def _prepare_objectives(valid_patches, extra_objectives=None, constraints=None):
+    extra_objectives = extra_objectives or {}
+    objective_cols = ['landcoverSuitability', 'slope', 'soil', 'floodRisk', 'urbanProximity'] + list(extra_objectives)
+    objective_weights = (1.0, 1.0, 1.0, 3.0, 1.0) + tuple(extra_objectives.values())
+    feasible = _feasible_patches(valid_patches, constraints)
+    # Min-max scaling with exact 0/1 endpoints, so normalizing an already-normalized
+    # frame again is a no-op and repeated seeded runs see identical objectives
+    values = valid_patches[objective_cols].to_numpy(dtype=float)
+    low, high = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+    valid_patches[objective_cols] = (values - low) / np.where(high > low, high - low, 1.0)
+    return objective_cols, objective_weights, feasible
+
+
+def _create_types(objective_weights):
+    # Re-creating DEAP classes warns and leaks; only do it when the weights change
+    fitness = getattr(creator, "FitnessMulti", None)
+    if fitness is not None and fitness.weights == tuple(objective_weights) and hasattr(creator, "Individual"):
+        return
+    creator.create("FitnessMulti", base.Fitness, weights=objective_weights)
+    creator.create("Individual", list, fitness=creator.FitnessMulti)
+
+
+def objective_matrix(df, objective_cols, objective_weights, feasible=None):
+    # Contiguous (n_patches, n_objectives) array of the already-normalized objective columns
+    objectives = np.ascontiguousarray(df[objective_cols].to_numpy(dtype=float))
+    if feasible is not None:
+        # Normalized objectives lie in [0, 1], so this is dominated by every feasible patch
+        objectives[~feasible] = -np.sign(objective_weights)
+    return objectives
+
+
+def _feasible_patches(df, constraints):
+    feasible = np.ones(len(df), dtype=bool)
+    for col, (low, high) in (constraints or {}).items():
+        values = df[col].to_numpy()
+        if low is not None:
+            feasible &= values >= low
+        if high is not None:
+            feasible &= values <= high
+    print(f"Feasible patches: {feasible.sum()} / {len(df)}")
+    return feasible
+
+
+def weighted_score(ind):
+    # Objective sum with the objective weights applied (floodRisk counts 3x)
+    return sum(ind.fitness.wvalues)
+
+
+def select_spatially_distributed(pop, df, min_dist, n, key=None, centroids=None):
+    # Greedy best-first pick of up to n patches at least min_dist apart.
+    # centroids: optional precomputed (n_patches, 2) array; otherwise read once from df
     seen = {}
     for ind in pop:
         seen[ind[0]] = ind
-    candidates = list(seen.values())
-    candidates = [c for c in candidates if c.fitness.valid]
-    candidates.sort(key=lambda x: sum(x.fitness.values), reverse=True)
+    candidates = [c for c in seen.values() if c.fitness.valid]
+    if not candidates:
+        print("✅ Selected 0 spatial patches")
+        return []
+    score = key or (lambda x: sum(x.fitness.values))
+    scores = np.array([score(c) for c in candidates])
+    order = np.argsort(-scores, kind="stable")
+
+    if centroids is None:
+        centroids = df[['centroid_x', 'centroid_y']].to_numpy(dtype=float)
+    points = centroids[np.array([c[0] for c in candidates])]
+    tree = cKDTree(points)
 
-    selected, centroids = [], []
-    for c in candidates:
+    blocked = np.zeros(len(candidates), dtype=bool)
+    selected = []
+    for i in order:
         if len(selected) >= n:
             break
-        idx = c[0]
-        pt = np.array([[df.iloc[idx]['centroid_x'], df.iloc[idx]['centroid_y']]])
-        if not centroids or cdist(pt, np.array(centroids)).min() >= min_dist:
-            selected.append(c)
-            centroids.append(pt[0])
+        if blocked[i]:
+            continue
+        selected.append(candidates[i])
+        # Block everything strictly closer than min_dist to the accepted patch
+        near = np.array(tree.query_ball_point(points[i], min_dist), dtype=np.int64)
+        if near.size:
+            dist = np.hypot(*(points[near] - points[i]).T)
+            blocked[near[dist < min_dist]] = True
     print(f"✅ Selected {len(selected)} spatial patches")
     return selected
 
 
-def summarize_results(selected, df):
-    records = []
-    for rank, ind in enumerate(selected):
-        idx = ind[0]
-        row = df.iloc[idx]
-        records.append({
-            'rank': rank + 1,
-            'patch_id': idx,
-            'centroid_x': row['centroid_x'],
-            'centroid_y': row['centroid_y'],
-            'score': sum(ind.fitness.values),
-            **{col: row[col] for col in ['slope', 'soil', 'floodRisk', 'urbanProximity', 'landcoverSuitability']}
-        })
-    return pd.DataFrame(records)
-def create_results_dataframe(selected_patches, patch_data):
-    import pandas as pd
-    import geopandas as gpd
+def build_results(indices, scores, patch_data, ranks=None, dedupe=False, rank_scores=None):
+    """
+    Results table for selected patch indices and their scores: rank, patch_id, score
+    and every patch_data column (including geometry), joined with one positional take.
+    With dedupe, each patch keeps its best entry (first on ties) and rows are ranked
+    by rank_scores (default scores); otherwise the given ranks (default 1..n) and
+    order are kept.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    scores = np.asarray(scores, dtype=float)
+    rank_scores = scores if rank_scores is None else np.asarray(rank_scores, dtype=float)
+    if dedupe:
+        order = np.lexsort((np.arange(len(indices)), -rank_scores))
+        _, first = np.unique(indices[order], return_index=True)
+        keep = order[np.sort(first)]
+        ranks = np.arange(1, len(keep) + 1)
+    else:
+        keep = np.arange(len(indices))
+        ranks = np.arange(1, len(indices) + 1) if ranks is None else np.asarray(ranks)
+
+    results = patch_data.iloc[indices[keep]].reset_index(drop=True)
+    results.insert(0, 'rank', ranks)
+    results.insert(1, 'patch_id', indices[keep])
+    results.insert(2, 'score', scores[keep])
+    return results
 
-    results = []
 
+def summarize_results(selected, df, dedupe=False, rank_key=None):
+    indices = [ind[0] for ind in selected]
+    scores = [sum(ind.fitness.values) for ind in selected]
+    rank_scores = [rank_key(ind) for ind in selected] if rank_key else None
+    results = build_results(indices, scores, df, dedupe=dedupe, rank_scores=rank_scores)
+    columns = ['rank', 'patch_id', 'centroid_x', 'centroid_y', 'score',
+               'slope', 'soil', 'floodRisk', 'urbanProximity', 'landcoverSuitability']
+    return pd.DataFrame(results[columns])
+
+
+def create_results_dataframe(selected_patches, patch_data, dedupe=False, rank_key=None):
+    # dedupe: keep each patch once, ranked by rank_key(individual) (default overall_score),
+    # e.g. weighted_score for modes that order their picks by the weighted objectives
+    import pandas as pd
+
+    ranks, indices, scores, rank_scores = [], [], [], []
     for i, patch in enumerate(selected_patches):
         # ✅ Robust patch index extraction
         try:
-            if hasattr(patch, "fitness") and isinstance(patch[0], int):
-                idx = patch[0]  # DEAP individual
-            elif isinstance(patch, int):
-                idx = patch
+            if hasattr(patch, "fitness") and isinstance(patch[0], (int, np.integer)):
+                idx = int(patch[0])  # DEAP individual
+            elif isinstance(patch, (int, np.integer)):
+                idx = int(patch)
             elif isinstance(patch, pd.Series) and 'patch_id' in patch:
                 idx = int(patch['patch_id'])
             else:
@@ -115,41 +614,40 @@ def create_results_dataframe(selected_patches, patch_data):
         except Exception as e:
             print(f"⚠️ Skipping patch {i}: couldn't extract index - {e}")
             continue
-
-        try:
-            patch_row = patch_data.iloc[idx]
-            geom = patch_row.geometry
-            minx, miny, maxx, maxy = geom.bounds
-
-            # Convert to UTM if needed
-            if patch_data.crs != 'EPSG:25831':
-                patch_gdf = gpd.GeoDataFrame([patch_row], geometry='geometry', crs=patch_data.crs)
-                patch_gdf = patch_gdf.to_crs('EPSG:25831')
-                geom_utm = patch_gdf.geometry.iloc[0]
-                minx, miny, maxx, maxy = geom_utm.bounds
-                centroid = geom_utm.centroid
-            else:
-                centroid = geom.centroid
-
-            results.append({
-                'rank': i + 1,
-                'patch_id': idx,
-                'centroid_longitude': patch_row['centroid_x'],
-                'centroid_latitude': patch_row['centroid_y'],
-                'centroid_x_utm31n': centroid.x,
-                'centroid_y_utm31n': centroid.y,
-                'bbox_coordinates_utm31n': f"{minx:.2f},{miny:.2f},{maxx:.2f},{maxy:.2f}",
-                'landcoverSuitability': patch_row.get('landcoverSuitability', 0),
-                'slope': patch_row.get('slope', 0),
-                'soil': patch_row.get('soil', 0),
-                'floodRisk': patch_row.get('floodRisk', 0),
-                'urbanProximity': patch_row.get('urbanProximity', 0),
-                'overall_score': sum(patch.fitness.values) if hasattr(patch, 'fitness') else 0
-            })
-        except Exception as e:
-            print(f"⚠️ Failed to process patch {idx}: {e}")
+        if not 0 <= idx < len(patch_data):
+            print(f"⚠️ Failed to process patch {idx}: index out of range")
             continue
+        ranks.append(i + 1)
+        indices.append(idx)
+        scores.append(sum(patch.fitness.values) if hasattr(patch, 'fitness') else 0)
+        if rank_key is not None:
+            rank_scores.append(rank_key(patch) if hasattr(patch, 'fitness') else 0)
 
-    return pd.DataFrame(results)
+    rows = build_results(indices, scores, patch_data, ranks=ranks, dedupe=dedupe,
+                         rank_scores=rank_scores if rank_key is not None else None)
+    geoms = gpd.GeoSeries(rows.geometry.to_numpy(), crs=patch_data.crs)
+    # Convert to UTM if needed, all selected patches in one call
+    if patch_data.crs != 'EPSG:25831':
+        geoms = geoms.to_crs('EPSG:25831')
+    bounds = geoms.bounds
+    centroids = geoms.centroid
 
+    def column(name):
+        return rows[name].to_numpy() if name in rows else np.zeros(len(rows))
 
+    return pd.DataFrame({
+        'rank': rows['rank'].to_numpy(),
+        'patch_id': rows['patch_id'].to_numpy(),
+        'centroid_longitude': column('centroid_x'),
+        'centroid_latitude': column('centroid_y'),
+        'centroid_x_utm31n': centroids.x.to_numpy(),
+        'centroid_y_utm31n': centroids.y.to_numpy(),
+        'bbox_coordinates_utm31n': [f"{minx:.2f},{miny:.2f},{maxx:.2f},{maxy:.2f}"
+                                    for minx, miny, maxx, maxy in bounds.to_numpy()],
+        'landcoverSuitability': column('landcoverSuitability'),
+        'slope': column('slope'),
+        'soil': column('soil'),
+        'floodRisk': column('floodRisk'),
+        'urbanProximity': column('urbanProximity'),
+        'overall_score': rows['score'].to_numpy()
+    })
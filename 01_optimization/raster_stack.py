@@ -0,0 +1,174 @@
+# raster_stack.py
+import os
+import numpy as np
+import rasterio
+from rasterio.warp import reproject, Resampling
+
+
+def layer_band(src, name):
+    # 1-based band of a layer: the band described as name in a multi-band stack, else band 1
+    if name in src.descriptions:
+        return src.descriptions.index(name) + 1
+    if src.count == 1:
+        return 1
+    raise KeyError(f"No band named {name} in {src.name}")
+
+
+def band_nodata(src, band):
+    # Per-band nodata tag written by gee_fetch for multi-band stacks, else the dataset nodata
+    nodata = src.tags(band).get('nodata')
+    return float(nodata) if nodata is not None else src.nodatavals[band - 1]
+
+
+def open_layer(path, name):
+    src = rasterio.open(path)
+    if src.count == 1:
+        return src
+    return BandView(src, layer_band(src, name))
+
+
+class BandView:
+    """
+    One band of an open multi-band dataset behind the single-band API used by
+    grid and mcda: read(1) returns this band and nodata is the band's own.
+    Every other attribute comes from the dataset.
+    """
+
+    def __init__(self, src, band):
+        self.src = src
+        self.band = band
+        self.nodata = band_nodata(src, band)
+
+    def read(self, band=1, window=None, **kwargs):
+        return self.src.read(self.band, window=window, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.src, attr)
+
+
+class StackLayer:
+    """
+    A decoded band aligned to the stack grid. Exposes the part of the rasterio
+    dataset API used by grid and mcda (read, nodata, transform, shape, bounds, crs),
+    so it can stand in for an open dataset without decoding the file again.
+    Nodata pixels are stored as NaN, hence nodata is always None.
+    """
+    nodata = None
+
+    def __init__(self, name, data, stack):
+        self.name = name
+        self.data = data
+        self.valid = ~np.isnan(data)
+        self.stack = stack
+        valid_count = int(self.valid.sum())
+        self.stats = {
+            'min': float(np.nanmin(data)) if valid_count else np.nan,
+            'max': float(np.nanmax(data)) if valid_count else np.nan,
+            'valid_count': valid_count,
+        }
+
+    def read(self, band=1, window=None):
+        if window is None:
+            return self.data
+        (row_start, row_stop), (col_start, col_stop) = window.toranges()
+        return self.data[row_start:row_stop, col_start:col_stop]
+
+    @property
+    def transform(self):
+        return self.stack.transform
+
+    @property
+    def shape(self):
+        return self.stack.shape
+
+    @property
+    def bounds(self):
+        return self.stack.bounds
+
+    @property
+    def crs(self):
+        return self.stack.crs
+
+
+class RasterStack:
+    """
+    Decodes every layer exactly once into an aligned float32 array (or .npy memmap
+    when memmap_dir is given) and keeps its nodata mask and min/max/valid_count.
+    Behaves like the {name: dataset} dict returned by grid.load_and_check_rasters.
+    Several names may share one multi-band file; each reads its band by name.
+    """
+
+    def __init__(self, file_paths, memmap_dir=None, reference=None):
+        if memmap_dir is not None:
+            os.makedirs(memmap_dir, exist_ok=True)
+        names = list(file_paths)
+        reference = reference or ('study_area' if 'study_area' in file_paths else names[0])
+        with rasterio.open(file_paths[reference]) as ref:
+            self.transform = ref.transform
+            self.crs = ref.crs
+            self.shape = ref.shape
+            self.bounds = ref.bounds
+            self.profile = ref.profile.copy()
+
+        self.layers = {}
+        for name in names:
+            with rasterio.open(file_paths[name]) as src:
+                self.layers[name] = StackLayer(name, self._decode(name, src, memmap_dir), self)
+
+    def _decode(self, name, src, memmap_dir):
+        band = layer_band(src, name)
+        nodata = band_nodata(src, band)
+        if memmap_dir is not None:
+            out = np.lib.format.open_memmap(os.path.join(memmap_dir, f"{name}.npy"),
+                                            mode="w+", dtype=np.float32, shape=self.shape)
+        else:
+            out = np.empty(self.shape, dtype=np.float32)
+
+        if src.shape == self.shape and src.transform == self.transform and src.crs == self.crs:
+            arr = src.read(band)
+            if nodata is not None:
+                out[:] = np.where(arr == nodata, np.nan, arr)
+            else:
+                out[:] = arr
+        else:
+            # Warp misaligned layers onto the reference grid
+            out[:] = np.nan
+            reproject(
+                source=rasterio.band(src, band),
+                destination=out,
+                src_transform=src.transform,
+                src_crs=src.crs,
+                src_nodata=nodata,
+                dst_transform=self.transform,
+                dst_crs=self.crs,
+                dst_nodata=np.nan,
+                resampling=Resampling.nearest
+            )
+            if nodata is not None:
+                out[out == nodata] = np.nan
+        return out
+
+    def __getitem__(self, name):
+        return self.layers[name]
+
+    def __contains__(self, name):
+        return name in self.layers
+
+    def __iter__(self):
+        return iter(self.layers)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def keys(self):
+        return self.layers.keys()
+
+    def items(self):
+        return self.layers.items()
+
+    def get(self, name, default=None):
+        return self.layers.get(name, default)
+
+    @property
+    def stats(self):
+        return {name: layer.stats for name, layer in self.layers.items()}
@@ -0,0 +1,107 @@
+# sensitivity.py
+import argparse
+import itertools
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from mcda import DEFAULT_LAYERS, _default_weights
+
+
+def sample_weights(n_layers, n_samples=5000, method="dirichlet", alpha=1.0, steps=10, seed=None):
+    """
+    Weight vectors on the simplex, shape (n_samples, n_layers).
+    method="dirichlet" draws n_samples from Dirichlet(alpha); alpha may be a scalar
+    or a per-layer array (e.g. concentration * default weights).
+    method="grid" enumerates every vector whose entries are multiples of 1/steps.
+    """
+    if method == "dirichlet":
+        rng = np.random.default_rng(seed)
+        return rng.dirichlet(np.broadcast_to(np.asarray(alpha, dtype=float), (n_layers,)), size=n_samples)
+    if method == "grid":
+        # Stars and bars: choose n_layers - 1 bar positions among steps + n_layers - 1 slots
+        vectors = []
+        for bars in itertools.combinations(range(steps + n_layers - 1), n_layers - 1):
+            edges = np.array((-1,) + bars + (steps + n_layers - 1,))
+            vectors.append(np.diff(edges) - 1)
+        return np.array(vectors, dtype=float) / steps
+    raise ValueError(f"Unknown weight sampling method: {method}")
+
+
+def patch_layer_matrix(valid_patches, layer_names=None):
+    # Patch-level layers min-max normalized per column, shape (n_patches, n_layers)
+    layer_names = layer_names or DEFAULT_LAYERS
+    values = valid_patches[layer_names].to_numpy(dtype=float)
+    low, high = values.min(axis=0), values.max(axis=0)
+    span = np.where(high > low, high - low, 1.0)
+    return (values - low) / span
+
+
+def weight_sensitivity(valid_patches, weights, layer_names=None, top_n=10, chunk_size=1000):
+    """
+    Rank stability of every patch across many weight vectors.
+    Scores for a chunk of weight vectors are one (patches x layers) @ (layers x chunk)
+    product, so memory is bounded by n_patches * chunk_size regardless of len(weights).
+    Rank 1 is the best patch.
+    """
+    layer_names = layer_names or DEFAULT_LAYERS
+    matrix = patch_layer_matrix(valid_patches, layer_names)
+    weights = np.asarray(weights, dtype=float)
+    n_patches, n_samples = len(matrix), len(weights)
+
+    rank_sum = np.zeros(n_patches)
+    rank_sq_sum = np.zeros(n_patches)
+    top_count = np.zeros(n_patches, dtype=np.int64)
+    ranks_base = np.arange(1, n_patches + 1, dtype=float)
+
+    for start in range(0, n_samples, chunk_size):
+        chunk = weights[start:start + chunk_size]
+        scores = matrix @ chunk.T
+        order = np.argsort(-scores, axis=0, kind="stable")
+        ranks = np.empty_like(scores)
+        np.put_along_axis(ranks, order, ranks_base[:, None], axis=0)
+        rank_sum += ranks.sum(axis=1)
+        rank_sq_sum += (ranks ** 2).sum(axis=1)
+        top_count += (ranks <= top_n).sum(axis=1)
+
+    mean_rank = rank_sum / n_samples
+    baseline_scores = matrix @ _default_weights()
+    baseline_rank = np.empty(n_patches)
+    baseline_rank[np.argsort(-baseline_scores, kind="stable")] = ranks_base
+
+    result = pd.DataFrame({
+        'patch_id': np.arange(n_patches),
+        'centroid_x': valid_patches['centroid_x'].to_numpy(),
+        'centroid_y': valid_patches['centroid_y'].to_numpy(),
+        'baseline_rank': baseline_rank.astype(int),
+        'mean_rank': mean_rank,
+        'rank_variance': np.maximum(rank_sq_sum / n_samples - mean_rank ** 2, 0.0),
+        f'p_top_{top_n}': top_count / n_samples,
+    })
+    print(f"✅ Evaluated {n_samples} weight vectors over {n_patches} patches")
+    return result.sort_values('mean_rank').reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCDA weight sensitivity over valid patches")
+    parser.add_argument("--output", type=str, default="05_results")
+    parser.add_argument("--samples", type=int, default=5000, help="Dirichlet weight samples")
+    parser.add_argument("--method", type=str, default="dirichlet", choices=["dirichlet", "grid"])
+    parser.add_argument("--steps", type=int, default=10, help="Simplex grid resolution")
+    parser.add_argument("--top_n", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    print("\n🔹 MCDA weight sensitivity")
+    valid_patches = gpd.read_file(os.path.join(args.output, "valid_patches.geojson"))
+    weights = sample_weights(len(DEFAULT_LAYERS), args.samples, args.method, steps=args.steps, seed=args.seed)
+    result = weight_sensitivity(valid_patches, weights, top_n=args.top_n)
+
+    out_path = os.path.join(args.output, "weight_sensitivity.csv")
+    result.to_csv(out_path, index=False, float_format="%.6g")
+    print(f"📤 Saved weight sensitivity to {out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,10 @@ import os
 import json
 import pickle
 import geopandas as gpd
+import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from plot_utils import plot_mcda_overlay, plot_2d_pareto_fronts
+from plot_utils import plot_mcda_overlay, plot_2d_pareto_fronts, plot_rank_stability
 from supabase import create_client
 from dotenv import load_dotenv
 
@@ -90,5 +91,16 @@ plt.close()
 
 upload_file_to_supabase(simple_pareto_path, f"{PROJECT_ID}/pareto_selected.png")
 
+sensitivity_path = os.path.join(RESULTS_DIR, "weight_sensitivity.csv")
+if os.path.exists(sensitivity_path):
+    print("🖼️ Generating weight sensitivity plot...")
+    sensitivity_df = pd.read_csv(sensitivity_path)
+    top_col = next(c for c in sensitivity_df.columns if c.startswith("p_top_"))
+    plot_rank_stability(sensitivity_df, top_n=int(top_col.rsplit("_", 1)[1]))
+    rank_stability_path = os.path.join(EXPORT_DIR, "rank_stability.png")
+    plt.savefig(rank_stability_path, dpi=300)
+    plt.close()
+    upload_file_to_supabase(rank_stability_path, f"{PROJECT_ID}/rank_stability.png")
+
 print("✅ All plots saved and uploaded to Supabase in", EXPORT_DIR)
 
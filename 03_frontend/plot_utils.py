@@ -111,3 +111,26 @@ def plot_3d_pareto_front_interactive(hof_all_runs, valid_patches, obj1, obj2, ob
         legend=dict(itemsizing='constant')
     )
     fig.show()
+
+
+def plot_rank_stability(sensitivity_df, top_n=10):
+    """
+    Scatter of mean rank vs rank spread across sampled MCDA weights.
+    Args:
+        sensitivity_df (DataFrame): output of sensitivity.weight_sensitivity (weight_sensitivity.csv)
+        top_n (int): N used for the p_top_N column
+    """
+    prob_col = f'p_top_{top_n}'
+    plt.figure(figsize=(8, 6))
+    sc = plt.scatter(
+        sensitivity_df['mean_rank'],
+        np.sqrt(sensitivity_df['rank_variance']),
+        c=sensitivity_df[prob_col],
+        cmap='viridis', vmin=0, vmax=1, s=12
+    )
+    cbar = plt.colorbar(sc)
+    cbar.set_label(f'P(top {top_n})')
+    plt.xlabel('Mean rank')
+    plt.ylabel('Rank std. deviation')
+    plt.title('MCDA Weight Sensitivity')
+    plt.tight_layout()